@@ -0,0 +1,172 @@
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import resource
+import multiprocessing
+import numpy as np
+import taichi as ti
+import diffmpm
+
+##Times the simulation of fixed seeded robots over a sweep of node counts, grid resolutions, step counts and
+##batch sizes, writes the results as JSON and optionally compares them with a stored baseline.
+##The first pass of every case includes compiling the kernels for its layout, later passes are timed
+
+higher_better = ['forward_steps_per_s', 'backward_steps_per_s', 'particle_steps_per_s', 'iterations_per_s']
+lower_better = ['p2g_ms', 'grid_op_ms', 'g2p_ms', 'field_mb', 'peak_rss_mb']
+
+
+def int_list(text):
+    return [int(v) for v in text.split(',')]
+
+def seeded_scenes(nodes, batch, seed):
+    ##The same robots for the same seed, built after set_grid() since particles are sampled from dx
+    rand_state, np_state = random.getstate(), np.random.get_state()
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        return [diffmpm.random_scene(nodes) for i in range(batch)]
+    finally:
+        random.setstate(rand_state)
+        np.random.set_state(np_state)
+
+def timed(f, *args):
+    ti.sync()
+    start = time.perf_counter()
+    f(*args)
+    ti.sync()
+    return time.perf_counter() - start
+
+def taped_pass():
+    ##Seconds of the forward and the backward half of one Tape pass
+    tape = diffmpm.tape()
+    tape.__enter__()
+    forward = timed(diffmpm.forward)
+    backward = timed(tape.__exit__, None, None, None)
+    return forward, backward
+
+def kernel_ms(reps):
+    ##Milliseconds per launch of the step kernels, on frame 0 of the last pass
+    times = {}
+    times['p2g_ms'] = timed(lambda: [(diffmpm.clear_grid(), diffmpm.p2g(0, 1, 0)) for i in range(reps)])
+    times['grid_op_ms'] = timed(lambda: [diffmpm.grid_op() for i in range(reps)])
+    times['g2p_ms'] = timed(lambda: [diffmpm.g2p(0, 1) for i in range(reps)])
+    return {name: 1000 * t / reps for name, t in times.items()}
+
+def run_case(nodes, n_grid, steps, batch, reps, seed):
+    diffmpm.set_grid(n_grid)
+    diffmpm.steps = steps
+    diffmpm.set_n_robots(batch)
+    scenes = seeded_scenes(nodes, batch, seed)
+    first = time.perf_counter()
+    diffmpm.fit_fields(scenes)
+    np.random.seed(seed)
+    diffmpm.load_batch(scenes)
+    taped_pass()
+    diffmpm.update_weights(0, reps + 1)
+    first = time.perf_counter() - first
+
+    forward, backward, iteration = [], [], []
+    for i in range(reps):
+        f, b = taped_pass()
+        iteration.append(f + b + timed(diffmpm.update_weights, i + 1, reps + 1))
+        forward.append(timed(diffmpm.forward))
+        backward.append(b)
+    forward, backward, iteration = min(forward), min(backward), min(iteration)
+    particles = int(diffmpm.robot_n_particles.to_numpy()[:batch].sum())
+    simulated = steps - 1
+    result = {'nodes': nodes, 'n_grid': n_grid, 'steps': steps, 'batch': batch, 'particles': particles,
+              'jit_s': max(0.0, first - iteration),
+              'forward_steps_per_s': simulated / forward,
+              'backward_steps_per_s': simulated / backward,
+              'particle_steps_per_s': particles * simulated / forward,
+              'iterations_per_s': 1 / iteration,
+              'field_mb': sum(size for name, shape, size in diffmpm.field_bytes()) / 2**20}
+    result.update(kernel_ms(100))
+    return result
+
+def case_process(case):
+    ##run_case() in a fresh process, so peak_rss_mb is the peak resident memory of this case alone
+    grid, fused, checkpoint = case[-3:]
+    diffmpm.render_mode = 'none'
+    diffmpm.grid_layout = grid
+    diffmpm.fused_steps = fused
+    diffmpm.set_checkpointing(checkpoint)
+    result = run_case(*case[:-3])
+    result['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return result
+
+def case_key(case, settings):
+    return 'nodes={nodes} n_grid={n_grid} steps={steps} batch={batch}'.format(**case) + \
+           ' grid={grid} fused={fused} checkpoint={checkpoint}'.format(**settings)
+
+def compare(results, baseline, threshold):
+    ##Lines describing every metric that got worse than the baseline by more than threshold (a fraction)
+    old = {case_key(case, baseline['settings']): case for case in baseline['cases']}
+    regressions = []
+    for case in results['cases']:
+        key = case_key(case, results['settings'])
+        if key not in old:
+            continue
+        for name in higher_better + lower_better:
+            before, after = old[key].get(name), case[name]
+            if not before:
+                continue
+            change = (after - before) / before
+            if (name in higher_better and change < -threshold) or (name in lower_better and change > threshold):
+                regressions.append('{}: {} {:.4g} -> {:.4g} ({:+.1%})'.format(key, name, before, after, change))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int_list, default=[4, 8]) ##Comma separated sweep values
+    parser.add_argument('--n-grid', type=int_list, default=[64, 128])
+    parser.add_argument('--steps', type=int_list, default=[256, 1024])
+    parser.add_argument('--batch', type=int_list, default=[1])
+    parser.add_argument('--reps', type=int, default=3) ##Timed passes per case, the fastest one is reported
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--grid', choices=['dense', 'bitmasked', 'pointer'], default=diffmpm.grid_layout)
+    parser.add_argument('--fused', action="store_true")
+    parser.add_argument('--checkpoint', type=int, default=0)
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--baseline', default='') ##Results file to compare with
+    parser.add_argument('--threshold', type=float, default=0.1) ##Allowed slowdown or growth as a fraction
+    options = parser.parse_args()
+    if max(options.steps) > diffmpm.max_steps:
+        parser.error('--steps cannot exceed {}, the max_steps the actuation fields are sized for'.format(diffmpm.max_steps))
+
+    diffmpm.set_checkpointing(options.checkpoint)
+    settings = {'grid': options.grid, 'fused': options.fused, 'checkpoint': diffmpm.checkpoint_every}
+    results = {'settings': settings, 'seed': options.seed, 'reps': options.reps,
+               'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                           'taichi': '.'.join(str(v) for v in ti.__version__), 'arch': str(ti.cfg.arch)},
+               'cases': []}
+    ctx = multiprocessing.get_context('spawn')
+    for n_grid in options.n_grid:
+        for nodes in options.nodes:
+            for steps in options.steps:
+                for batch in options.batch:
+                    with ctx.Pool(1) as pool:
+                        case = pool.apply(case_process, [(nodes, n_grid, steps, batch, options.reps, options.seed,
+                                                          options.grid, options.fused, options.checkpoint)])
+                    results['cases'].append(case)
+                    print('{:<70} {:>10.0f} fwd steps/s {:>10.0f} bwd steps/s {:>8.2f} it/s {:>8.1f} MB {:>8.1f} MB peak jit {:.1f}s'.format(
+                        case_key(case, settings), case['forward_steps_per_s'], case['backward_steps_per_s'],
+                        case['iterations_per_s'], case['field_mb'], case['peak_rss_mb'], case['jit_s']), flush=True)
+    with open(options.out, 'w') as f:
+        json.dump(results, f, indent=1)
+
+    if options.baseline:
+        with open(options.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), options.threshold)
+        for line in regressions:
+            print('Regression', line, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print('No regressions over {:.0%} against {}'.format(options.threshold, options.baseline))
+
+if __name__ == "__main__":
+    main()
@@ -1,95 +1,65 @@
-import subprocess
-import sys
-import ast
-import json
+import argparse
 import matplotlib.pyplot as plt
+import diffmpm
 
+##Every generation runs in this process, so Python, Taichi and the kernels are only initialized once.
+##Fields are sized from the robots of each generation and moved to a new SNode tree when robots grow
+
+nodes = 6 ##Nodes of the initial robots
+population = 10 ##Robots in the initial generation
+mutations = 10 ##Mutants per mutation generation
+
+
+def losses():
+    ##Winning loss of every generation of the latest run, from the archive
+    return [row['loss'] for row in diffmpm.run_archive.winners()]
 
 ##Run initial generation
-##Robots, losses = run init gen
+def initial_generation(options, cache=None):
+    result = diffmpm.initial_generation(nodes, population, options.iters, options.batch, options.workers, cache,
+                                        options.screen, options.promote)
+    print(result['loss'], result['robot'])
+    diffmpm.store_robot(result) #Store robot and its controller, the next mutation starts from them
+    return result
 
-def initial_generation():
-    result = subprocess.run([sys.executable, "diffmpm.py"], capture_output=True, text=True) 
-#print(result)
-    output = result.stdout.strip()
-    mutations = 2
-    if result.returncode == 0:
-    #print(f"Raw Output:\n{output}")  # Debugging: See all output
+##Run mutations on the stored robot, keep the best
+def mutation(options, cache=None):
+    base_robot, control = diffmpm.load_robot()
+    result = diffmpm.mutation_generation(base_robot, mutations, options.iters, options.batch, options.workers, cache,
+                                         options.screen, options.promote, control)
+    print(result['loss'], result['robot'])
+    diffmpm.store_robot(result) #Store robot and its controller, the next mutation starts from them
+    return result
 
-                # Split output into lines
-        lines = output.split("\n")
-        print(lines)
-        losses_over_generation = []
-        original_robot_loss = lines[-2]##Loss is printed first
-        og_loss = ast.literal_eval(original_robot_loss)
-        losses_over_generation.append(og_loss)
-        original_robot = lines[-1]#Robot printed second
-        original_robot = ast.literal_eval(original_robot)
-        print(original_robot_loss, original_robot)
-    
-        with open("robotstorage.json", 'w') as f:
-            f.truncate(0)
-            json.dump(original_robot, f) #Store robot
-            f.close()
-        with open("loss_storage.json", 'w') as f:
-            f.truncate(0)
-            json.dump([og_loss], f) #Store Loss 
-            f.close()
-        with open('robotstorage.json', 'r') as f:
-            og_robot = json.load(f) #Robot storage sanity check
-            f.close()
-        if og_robot != original_robot:
-            print("ruh roh")
-            print(og_robot)
-        return 
-    
-##Run mutations on top robots
-##Robots, losses = run mutation gen
-##First step is to modify diffmpm to either run the mutation track or run the generation track
-##Then have mutation track take a robot as input
-##Then mutate, keep best, etc.\\\\\\\\\\\\\\\\\\\\\\\\\\\\\\
-def mutation():
+def evolve(generations, options, cache=None):
+    ##Initial generation followed by generations mutation generations. Returns the winner of every
+    ##generation as a dict of loss, robot, weights and bias. A resumed run continues after its finished generations
+    results = list(diffmpm.snapshot.generations()) if diffmpm.snapshot else []
+    if results:
+        diffmpm.store_robot(results[-1]) ##The run may have stopped before the winner was stored
+    else:
+        results.append(initial_generation(options, cache))
+    while len(results) <= generations:
+        results.append(mutation(options, cache))
+        if cache:
+            diffmpm.save_cache(cache) ##Keep what was learned if a later generation fails
+    return results
 
-    
-    result = subprocess.run([sys.executable, "-u", "diffmpm.py", "-mutate"], capture_output=True, text=True)
-    output = result.stdout.strip()
-    print(result.stderr)
-    lines = output.split("\n")
-    print(lines)
-    mutant_loss = lines[2]
-    print(mutant_loss)
-    mutant_robot = lines[3]
-        
-    mutant_loss = ast.literal_eval(mutant_loss)
-    mutant_robot = ast.literal_eval(mutant_robot)
-    print(mutant_robot)
-    #### See initial_generation
-    with open("robotstorage.json", 'w') as f:
-        f.truncate(0)
-        json.dump(mutant_robot, f)
-        f.close()
-    with open("loss_storage.json", 'r') as f:
-        loss_list = json.load(f)
-        loss_list.append(mutant_loss)
-        f.close()
-    with open("loss_storage.json", 'w') as f:
-        f.truncate(0)
-        json.dump(loss_list, f)
-        f.close()
-    with open('robotstorage.json', 'r') as f:
-        xman_robot = json.load(f)
-        f.close()
-    if xman_robot != mutant_robot:
-            #print("ruh roh")
-        print(xman_robot)
-    return
+def steady(evaluations, options, cache=None):
+    ##Steady-state evolution of evaluations robots with population elites, see diffmpm.steady_state()
+    result = diffmpm.steady_state(nodes, population, evaluations, options.iters, options.batch, options.workers, cache,
+                                  options.tournament)
+    print(result['loss'], result['robot'])
+    diffmpm.store_robot(result) #Store robot and its controller, the next mutation starts from them
+    return result
 
 def view():
-    ##See initial generation
-    result = subprocess.run([sys.executable, "-u", "diffmpm.py", "-view"], capture_output=True, text=True)
-    
-    with open('loss_storage.json', 'r') as f:
-        list = json.load(f)
+    ##Optimize the stored robot while drawing it, then plot the losses of every generation
+    robot, control = diffmpm.load_robot()
+    diffmpm.view(robot, 50, control)
+    diffmpm.finish_frames()
+
+    list = losses()
     if list:
         print(list)
         plt.title("Mutants")
@@ -97,46 +67,54 @@ def view():
         plt.xlabel("Generation")
         plt.plot(list)
         plt.show()
-        
-    
-    
+
 
 def main():
     ##Main Function
-    ##Due to issues with the initialization of the taichi kernel, each generation is run separately and then stored
-    ## To clear previous robots and generate an inital population, set val = 1
-    ## To generate a mutation of the previous population, set val = 0
+    ## With --generations n, an initial population and n mutation generations are run without prompting
+    ## With --steady n, n robots are evolved steady-state without generations
+    ## Otherwise:
+    ## To clear previous robots and generate an inital population, set val = 0
+    ## To generate a mutation of the previous population, set val = 1
     ## To view the robot created, set val = 2
-    
-    print("\n\n0: Initial generation, this will overwrite any existing data")
-    print("1: Mutation")
-    print("2: View\n")
-    val = int(input(">> "))
-    if val != 0 and val != 1 and val != 2:
-        print('Invalid Input -- Returning')
-        return
-    if val == 0:
-        with open('robotstorage.json', 'w') as f:
-            f.truncate(0)
-        with open('loss_storage.json', 'w') as f:
-            f.truncate(0)
-        initial_generation()
-    elif val==1:
-        mutation()
-    elif val==2:
-        view()
-    
-    with open('loss_storage.json', 'r') as f:
-        list = json.load(f)
-        print(list)
-        
-if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--generations', type=int, default=-1) ##Mutation generations after the initial one
+    parser.add_argument('--steady', type=int, default=0) ##Robots to evaluate in a steady-state run, 0 = generations
+    parser.add_argument('--tournament', type=int, default=3) ##Elites drawn for every parent selection of --steady
+    diffmpm.add_options(parser)
+    options = parser.parse_args()
+    cache = diffmpm.apply_options(options)
+    if diffmpm.run_archive is None:
+        parser.error('the loss history is kept in the run archive, --archive cannot be empty')
 
-   
-### \nBest Loss: x\n
-### \nBest Robot: x\n
+    finished = True ##A run completed, so its snapshot is removed
+    if options.steady > 0:
+        steady(options.steady, options, cache)
+        if cache:
+            diffmpm.save_cache(cache)
+    elif options.generations >= 0:
+        evolve(options.generations, options, cache)
+    else:
+        print("\n\n0: Initial generation, this will overwrite any existing data")
+        print("1: Mutation")
+        print("2: View\n")
+        val = int(input(">> "))
+        if val != 0 and val != 1 and val != 2:
+            print('Invalid Input -- Returning')
+            return
+        if val == 0:
+            initial_generation(options, cache)
+        elif val==1:
+            mutation(options, cache)
+        elif val==2:
+            view()
+        if cache and val != 2:
+            diffmpm.save_cache(cache)
+        finished = val != 2
+    if diffmpm.snapshot and finished:
+        diffmpm.snapshot.finish() ##Nothing left to resume
 
+    print(losses())
 
-    
- 
\ No newline at end of file
+if __name__ == "__main__":
+    main()
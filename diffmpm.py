@@ -7,6 +7,19 @@ import matplotlib.pyplot as plt
 import networkx as nx
 import random as rand
 import json
+import multiprocessing
+import concurrent.futures
+import sys
+import threading
+import queue
+import atexit
+import time
+import re
+import contextlib
+from fitness_cache import FitnessCache, morphology_key
+from run_archive import RunArchive
+from snapshot import Snapshot
+from job_queue import QueueJobs, open_queue, run_worker
 
 
 real = ti.f32
@@ -14,138 +27,475 @@ ti.init(default_fp=real, arch=ti.cpu, flatten_if=True)
 #ti.set_logging_level(ti.ERROR)
 dim = 2
 ##n_particles = 8192 ## #OG
-n_particles = 16384
+n_particles = 16384 ##Particle slots per robot, set by fit_fields() from the robots being simulated
+particle_bucket = 1024 ##Slots are rounded up to a multiple of this so growing a robot by a node rarely reallocates
 n_solid_particles = 0
 n_actuators = 0
-n_grid = 128
+n_robots = 1 ##Population dimension, every robot in a batch is simulated by the same kernel launches
+n_grid = 128 ##Grid cells per side, change with set_grid()
 dx = 1 / n_grid
 inv_dx = 1 / dx
+grid_layout = 'dense' ##dense, bitmasked or pointer. Sparse grids only clear and update the blocks p2g touched
+grid_block = 8 ##Cells per side of a sparse grid block
+particle_density = 2 ##Particles per grid cell along each side, scenes built afterwards sample at this density
 dt = 1e-3
 p_vol = 1  ##lower = more elastic
 E = 10##lower = more elastic, connections between particles
 # TODO: update
 mu = E
 la = E
-max_steps = 2048
-steps = 1024
+max_steps = 2048 ##Longest simulation, sizes the actuation field
+steps = 1024 ##Optimization horizon, sizes the trajectory when not checkpointing
+saturated_share = 725 / 1024 ##Share of steps whose actuation is saturated, the controller only acts after them
+checkpoint_every = 0 ##K > 0 keeps only a K + 1 frame window plus one checkpoint every K steps, 0 stores every frame
+screening = False ##Forward passes only: two frames of x, v, C and F used in turn and no gradients, set by screen()
+trajectory_precision = 'f32' ##f16 stores v, C and F of every frame, their gradients and checkpoints in half precision
+particle_order = 'none' ##none keeps the Scene order, morton or rows sort each robot's particles by grid cell when loaded
+resort_every = 0 ##Optimization iterations between re-sorts by the positions of the last pass, 0 = sort only when loaded
+last_frame = 0 ##Trajectory frame holding the final state of the last forward()
+fused_steps = False ##G2P of a step and P2G of the next in one particle loop, the backward pass still goes step by step
 gravity = 3.8
 target = [0.8, 0.2]
 
 scalar = lambda: ti.field(dtype=real)
-vec = lambda: ti.Vector.field(dim, dtype=real)
-mat = lambda: ti.Matrix.field(dim, dim, dtype=real)
-
-actuator_id = ti.field(ti.i32)
-particle_type = ti.field(ti.i32)
-x, v = vec(), vec()
-grid_v_in, grid_m_in = vec(), scalar()
-grid_v_out = vec()
-C, F = mat(), mat()
-
-loss = scalar()
+vec = lambda dtype=real: ti.Vector.field(dim, dtype=dtype)
+mat = lambda dtype=real: ti.Matrix.field(dim, dim, dtype=dtype)
+
+##Fields are created by allocate_fields() once the robots are known
+actuator_id = particle_type = None
+robot_n_particles = robot_n_solid = None ##Particles actually used by each robot, the rest of the slot is padding
+x = v = C = F = None
+grid_v_in = grid_m_in = grid_v_out = None
+grid_blocks = grid_out_blocks = None ##Block SNodes of a sparse grid
+grid_cells = None ##Active and occupied grid cells, filled by count_grid_cells()
+report_grid = False
+grid_activity = [] ##(step, active cells, occupied cells) over all robots, recorded by step() when report_grid is set
+x_ckpt = v_ckpt = C_ckpt = F_ckpt = None ##Segment start states, slot 0 always holds the state the robot was loaded with
+
+loss = None ##Sum of robot_loss, robots are independent so each one gets its own gradient
+robot_loss = None
 
 n_sin_waves = 4
-weights = scalar()
-bias = scalar()
-x_avg = vec()
-
-actuation = scalar()
+weights = bias = None
+com = com_v = None ##Centre of mass and mean velocity of every robot's solid particles after each step
+metrics = None ##metric_names of every robot, from the last forward() that streamed them
+metric_names = ['distance', 'speed', 'energy', 'bounce', 'height']
+metric_weights = {} ##Weight of each metric in the loss, which is -x of the final centre of mass plus the weighted metrics
+report_metrics = False ##Stream the metrics every step even when none of them is weighted in the loss
+metric_block = 32 ##Particles or steps one thread sums in registers before a single atomic add
+
+actuation = None
 actuation_omega = 20
 act_strength = 4
 
-
+optimizer = 'sgd' ##sgd, momentum or adam
+learning_rate = 0.1
+lr_schedule = 'constant' ##constant, cosine (decays to 0 over the run) or step (halves every lr_step iterations)
+lr_step = 10
+momentum = 0.9
+beta1 = 0.9 ##Adam moment decay rates
+beta2 = 0.999
+grad_clip = 0.0 ##Largest gradient norm per robot, 0 = no clipping
+patience = 0 ##Stop a robot after this many iterations without improving its loss by tolerance, 0 = never
+tolerance = 1e-4
+warm_start = True ##Mutants start from their parent's optimized weights and bias when those are known
+halving = 0 ##Successive halving: after every rung only the best 1/halving robots keep training, 0 = all train for every iteration
+weights_m = weights_s = bias_m = bias_s = None ##Optimizer moments, only momentum and Adam use them
+robot_training = None ##1 while a robot's weights are still being optimized
+allocation = None ##Layout of the current fields, allocate_fields() is only called again when it changes
+trees = [] ##SNode trees of the current fields, destroyed on reallocation
+report_memory = False ##Print field_bytes() to stderr after every allocation
+profiling = False ##Wall-clock spans around every phase plus the Taichi kernel profiler, turned on by set_profiling()
+profile_path = '' ##Every generation's profile is appended to this file as a line of JSON
+profile_spans = {} ##[seconds, calls] per phase since the last take_profile()
+profile_robots = [] ##Time share of every robot optimized since the last take_profile()
+profile_start = 0.0
+profile_generation = 0
+fresh_layout = False ##The next Tape pass is the first on new fields, so it mostly compiles kernels
+
+
+
+def stored(name):
+    ##Type of a trajectory field. x keeps f32 in every mode: a step moves particles by dt * v, which is below
+    ##the f16 resolution of positions near 1 and would freeze slow particles
+    if trajectory_precision == 'f16' and name != 'x':
+        return ti.f16
+    return real
+
+def trajectory_frames():
+    ##Frames held by x, v, C and F
+    if screening:
+        return 2
+    if checkpoint_every:
+        return checkpoint_every + 1
+    return steps
+
+def streaming():
+    ##Whether every step records the centre of mass for the metrics, otherwise only the final frame is measured
+    return report_metrics or any(metric_weights.values())
+
+def n_checkpoints():
+    if checkpoint_every and not screening:
+        return (steps - 2) // checkpoint_every + 1
+    return 1
 
 def allocate_fields():
-    ti.root.dense(ti.ij, (n_actuators, n_sin_waves)).place(weights)
-    ti.root.dense(ti.i, n_actuators).place(bias)
+    ##Creates every field for the current sizes. Fields from a previous allocation are freed and
+    ##kernels are recompiled against the new ones
+    global allocation, trees, actuator_id, particle_type, robot_n_particles, robot_n_solid
+    global x, v, C, F, grid_v_in, grid_m_in, grid_v_out, grid_blocks, grid_out_blocks, grid_cells, x_ckpt, v_ckpt, C_ckpt, F_ckpt
+    global loss, robot_loss, weights, bias, com, com_v, metrics, actuation
+    global weights_m, weights_s, bias_m, bias_s, robot_training
+    if trees:
+        for tree in trees:
+            tree.destroy()
+        trees = []
+        ti.lang.impl.get_runtime().clear_compiled_functions()
+
+    actuator_id = ti.field(ti.i32)
+    particle_type = ti.field(ti.i32)
+    robot_n_particles = ti.field(ti.i32)
+    robot_n_solid = ti.field(ti.i32)
+    x, v = vec(stored('x')), vec(stored('v'))
+    grid_v_in, grid_m_in = vec(), scalar()
+    grid_v_out = vec()
+    C, F = mat(stored('C')), mat(stored('F'))
+    loss = scalar()
+    robot_loss = scalar()
+    weights = scalar()
+    bias = scalar()
+    com, com_v = vec(), vec()
+    metrics = scalar()
+    actuation = scalar()
+
+    ##Every field gets a leading robot index so a whole batch runs in one launch per step
+    fb = ti.FieldsBuilder()
+    fb.dense(ti.ijk, (n_robots, n_actuators, n_sin_waves)).place(weights)
+    fb.dense(ti.ij, (n_robots, n_actuators)).place(bias)
+
+    fb.dense(ti.ijk, (n_robots, max_steps, n_actuators)).place(actuation)
+    fb.dense(ti.ij, (n_robots, n_particles)).place(actuator_id, particle_type)
+    fb.dense(ti.i, n_robots).place(robot_n_particles, robot_n_solid)
+    fb.dense(ti.i, n_robots).dense(ti.j, trajectory_frames()).dense(ti.k, n_particles).place(x, v, C, F)
+    if grid_layout == 'dense':
+        grid_blocks = grid_out_blocks = None
+        fb.dense(ti.i, n_robots).dense(ti.jk, n_grid).place(grid_v_in, grid_m_in, grid_v_out)
+    else:
+        ##grid_v_out gets its own blocks so clearing the input grid leaves it for the fused G2P
+        grid_blocks = getattr(fb.dense(ti.i, n_robots), grid_layout)(ti.jk, n_grid // grid_block)
+        grid_blocks.dense(ti.jk, grid_block).place(grid_v_in, grid_m_in)
+        grid_out_blocks = getattr(fb.dense(ti.i, n_robots), grid_layout)(ti.jk, n_grid // grid_block)
+        grid_out_blocks.dense(ti.jk, grid_block).place(grid_v_out)
+    fb.dense(ti.i, n_robots).place(robot_loss)
+    fb.dense(ti.ij, (n_robots, max_steps)).place(com, com_v)
+    fb.dense(ti.ij, (n_robots, len(metric_names))).place(metrics)
+    fb.place(loss)
+
+    if not screening:
+        fb.lazy_grad()
+    trees.append(fb.finalize())
+
+    ##Own tree so lazy_grad does not give optimizer state and checkpoints gradients
+    weights_m, weights_s = scalar(), scalar()
+    bias_m, bias_s = scalar(), scalar()
+    robot_training = ti.field(ti.i32)
+    grid_cells = ti.field(ti.i32)
+    fb = ti.FieldsBuilder()
+    fb.dense(ti.ijk, (n_robots, n_actuators, n_sin_waves)).place(weights_m, weights_s)
+    fb.dense(ti.ij, (n_robots, n_actuators)).place(bias_m, bias_s)
+    fb.dense(ti.i, n_robots).place(robot_training)
+    fb.dense(ti.i, 2).place(grid_cells)
+    x_ckpt, v_ckpt = vec(stored('x')), vec(stored('v'))
+    C_ckpt, F_ckpt = mat(stored('C')), mat(stored('F'))
+    fb.dense(ti.i, n_robots).dense(ti.j, n_checkpoints()).dense(ti.k, n_particles).place(x_ckpt, v_ckpt, C_ckpt, F_ckpt)
+    trees.append(fb.finalize())
+    allocation = layout()
+    if report_memory:
+        print_memory_report()
+
+def layout():
+    return (n_robots, n_particles, n_actuators, trajectory_frames(), checkpoint_every, steps, n_grid, grid_layout,
+            fused_steps, screening, trajectory_precision, streaming(), tuple(sorted(metric_weights.items())))
+
+def fit_fields(scenes):
+    ##Sizes the fields for scenes, reallocating only when a robot outgrows the particle bucket or the layout changes
+    global n_particles, fresh_layout
+    assert steps <= max_steps, "steps cannot exceed max_steps ({}), which sizes actuation and com".format(max_steps)
+    needed = max([scene.n_particles for scene in scenes] + [1])
+    if allocation is not None and needed <= n_particles:
+        if allocation == layout():
+            return
+    else:
+        n_particles = -(-needed // particle_bucket) * particle_bucket
+    with span('allocate'):
+        allocate_fields()
+    fresh_layout = True
+
+def field_bytes():
+    ##Bytes held by every field and its gradient, in allocation order
+    names = ['weights', 'bias', 'actuation', 'actuator_id', 'particle_type', 'robot_n_particles',
+             'robot_n_solid', 'x', 'v', 'C', 'F', 'grid_v_in', 'grid_m_in', 'grid_v_out',
+             'robot_loss', 'com', 'com_v', 'metrics', 'loss']
+    no_grad = ['weights_m', 'weights_s', 'bias_m', 'bias_s', 'robot_training', 'x_ckpt', 'v_ckpt', 'C_ckpt', 'F_ckpt']
+    report = []
+    for name in names + no_grad:
+        field = globals()[name]
+        if field is None:
+            continue
+        elements = int(np.prod(field.shape)) if field.shape else 1
+        if isinstance(field, ti.MatrixField):
+            elements *= field.n * field.m
+        size = elements * np.dtype(ti.lang.util.to_numpy_type(field.dtype)).itemsize
+        if field.dtype in (real, ti.f16) and name not in no_grad and not screening:
+            size *= 2 ##Gradient from lazy_grad
+        if name.startswith('grid_') and grid_layout == 'pointer':
+            size = 0 ##Blocks are allocated as p2g activates them
+        report.append((name, field.shape, size))
+    return report
+
+def print_grid_report():
+    ##Summary of the grid cells visited per step since the last report
+    global grid_activity
+    if not grid_activity:
+        return
+    active = np.array([a for s, a, o in grid_activity])
+    occupied = np.array([o for s, a, o in grid_activity])
+    cells = n_robots * n_grid * n_grid
+    print('Grid cells per step over {} steps ({} layout, {} cells): active mean {:.0f} max {} ({:.1%}), occupied mean {:.0f} max {}'.format(
+        len(grid_activity), grid_layout, cells, active.mean(), active.max(), active.mean() / cells, occupied.mean(), occupied.max()),
+        file=sys.stderr)
+    grid_activity = []
+
+def print_memory_report():
+    report = field_bytes()
+    print('Allocated fields (including gradients):', file=sys.stderr)
+    for name, shape, size in report:
+        print('  {:<18}{:<24}{:>12.2f} MB'.format(name, str(shape), size / 2**20), file=sys.stderr)
+    print('  {:<42}{:>12.2f} MB'.format('total', sum(size for name, shape, size in report) / 2**20), file=sys.stderr)
+
+class Span:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        ti.sync()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        ti.sync()
+        total = profile_spans.setdefault(self.name, [0.0, 0])
+        total[0] += time.perf_counter() - self.start
+        total[1] += 1
+
+no_span = contextlib.nullcontext()
+
+def span(name):
+    ##Times a phase when profiling, otherwise a shared context that does nothing
+    return Span(name) if profiling else no_span
+
+def set_profiling(path):
+    ##Restarts Taichi with the kernel profiler, so it has to be called before any fields are allocated
+    global profiling, profile_path, allocation
+    profiling, profile_path = True, path
+    ti.init(default_fp=real, arch=ti.cpu, flatten_if=True, kernel_profiler=True)
+    allocation = None
+    take_profile()
+
+def kernel_profile():
+    ##Seconds per kernel since the last call, gradient kernels are listed as <kernel>.grad
+    from taichi.profiler.kernel_profiler import get_default_kernel_profiler
+    profiler = get_default_kernel_profiler()
+    profiler._update_records() ##The profiler only prints its records, so they are read directly
+    kernels = {}
+    for record in profiler._traced_records:
+        name = re.match(r'(.*?)_c\d+_\d+', record.name)
+        name = name.group(1) if name else record.name
+        if 'reverse_grad' in record.name:
+            name += '.grad'
+        kernels[name] = kernels.get(name, 0.0) + record.kernel_time / 1000
+    ti.profiler.clear_kernel_profiler_info()
+    return dict(sorted(kernels.items(), key=lambda item: -item[1]))
+
+def take_profile():
+    ##Phases, kernels and robots since the last call, and starts a new period
+    global profile_spans, profile_robots, profile_start
+    now = time.perf_counter()
+    profile = {'wall_s': now - profile_start,
+               'phases': {name: {'seconds': t, 'calls': n} for name, (t, n) in profile_spans.items()},
+               'kernels': kernel_profile(), 'robots': profile_robots}
+    profile_spans, profile_robots, profile_start = {}, [], now
+    return profile
+
+def write_profile(kind):
+    ##Appends the profile of the generation that just finished to profile_path and summarizes it on stderr
+    global profile_generation
+    profile = take_profile()
+    profile['generation'] = profile_generation
+    profile['kind'] = kind
+    profile_generation += 1
+    if profile_path:
+        with open(profile_path, 'a') as f:
+            f.write(json.dumps(profile) + '\n')
+    phases = ', '.join('{} {:.2f}s'.format(name, p['seconds']) for name, p in profile['phases'].items())
+    kernels = ', '.join('{} {:.2f}s'.format(name, t) for name, t in list(profile['kernels'].items())[:5])
+    print('Generation {} ({}, {} robots): {:.2f}s, {}'.format(profile['generation'], kind, len(profile['robots']),
+                                                            profile['wall_s'], phases), file=sys.stderr)
+    print('  slowest kernels: ' + kernels, file=sys.stderr)
+
+def set_checkpointing(k):
+    ##Takes effect at the next fit_fields(), k < 0 picks sqrt(steps) which balances window and checkpoint memory
+    global checkpoint_every
+    if k < 0:
+        k = int(math.ceil(math.sqrt(steps)))
+    checkpoint_every = k
+
+##Settings a worker process needs to reproduce this process' runs
+config_names = ['checkpoint_every', 'n_grid', 'particle_density', 'steps', 'grid_layout', 'fused_steps', 'trajectory_precision', 'particle_order',
+                'resort_every', 'optimizer', 'learning_rate', 'lr_schedule', 'lr_step', 'momentum', 'beta1', 'beta2',
+                'grad_clip', 'patience', 'tolerance', 'metric_weights', 'report_metrics']
+
+def set_grid(n, layout=None):
+    ##Takes effect at the next fit_fields(), scenes sample particles from dx so build them afterwards.
+    ##Above 128 cells dt shrinks with dx to stay stable, so the same steps cover less simulated time
+    global n_grid, dx, inv_dx, dt, grid_layout
+    if layout is not None:
+        grid_layout = layout
+    assert grid_layout == 'dense' or n % grid_block == 0, "Sparse grids need n_grid to be a multiple of grid_block"
+    n_grid = n
+    dx = 1 / n_grid
+    inv_dx = 1 / dx
+    dt = 1e-3 * min(1, 128 / n_grid)
+
+coarse_fidelity = {'n_grid': 64, 'particle_density': 2, 'steps': 512} ##Cheap level used to pick the robots promoted to full fidelity
+
+@contextlib.contextmanager
+def fidelity(level):
+    ##Runs the block at another grid resolution, particle density and step count, given as a dict like
+    ##coarse_fidelity. Scenes have to be built inside the block, since they sample particles from dx
+    global particle_density, steps
+    assert level['steps'] <= max_steps, "The steps of a fidelity cannot exceed max_steps ({})".format(max_steps)
+    saved = (n_grid, particle_density, steps)
+    set_grid(level['n_grid'])
+    particle_density, steps = level['particle_density'], level['steps']
+    try:
+        yield
+    finally:
+        set_grid(saved[0])
+        particle_density, steps = saved[1:]
+
+def get_config():
+    return {name: globals()[name] for name in config_names}
+
+def set_config(config):
+    globals().update(config)
+    set_grid(n_grid) ##dx follows n_grid
 
-    ti.root.dense(ti.ij, (max_steps, n_actuators)).place(actuation)
-    ti.root.dense(ti.i, n_particles).place(actuator_id, particle_type)
-    ti.root.dense(ti.k, max_steps).dense(ti.l, n_particles).place(x, v, C, F)
-    ti.root.dense(ti.ij, n_grid).place(grid_v_in, grid_m_in, grid_v_out)
-    ti.root.place(loss, x_avg)
 
-    ti.root.lazy_grad()
+@ti.kernel
+def clear_grid():
+    for r, i, j in grid_m_in:
+        grid_v_in[r, i, j] = [0, 0]
+        grid_m_in[r, i, j] = 0
+        if ti.static(not screening):
+            grid_v_in.grad[r, i, j] = [0, 0]
+            grid_m_in.grad[r, i, j] = 0
+            grid_v_out.grad[r, i, j] = [0, 0]
+    if ti.static(grid_layout != 'dense'):
+        ##Only active cells were visited above, dropping their blocks leaves the next p2g an empty grid.
+        ##Bitmasked blocks keep their memory, which is why they are zeroed first
+        for r, i, j in grid_blocks:
+            ti.deactivate(grid_blocks, [r, i, j])
+        if ti.static(not fused_steps): ##The fused G2P still reads grid_v_out after the clear
+            for r, i, j in grid_out_blocks:
+                ti.deactivate(grid_out_blocks, [r, i, j])
 
 
 @ti.kernel
-def clear_grid():
-    for i, j in grid_m_in:
-        grid_v_in[i, j] = [0, 0]
-        grid_m_in[i, j] = 0
-        grid_v_in.grad[i, j] = [0, 0]
-        grid_m_in.grad[i, j] = 0
-        grid_v_out.grad[i, j] = [0, 0]
+def count_grid_cells():
+    ##Cells grid_op visits and cells that received mass, over all robots
+    grid_cells[0] = 0
+    grid_cells[1] = 0
+    for r, i, j in grid_m_in:
+        grid_cells[0] += 1
+        if grid_m_in[r, i, j] > 0:
+            grid_cells[1] += 1
 
 
 @ti.kernel
-def clear_particle_grad():
-    # for all time steps and all particles
-    for f, i in x:
-        x.grad[f, i] = [0, 0]
-        v.grad[f, i] = [0, 0]
-        C.grad[f, i] = [[0, 0], [0, 0]]
-        F.grad[f, i] = [[0, 0], [0, 0]]
+def clear_particle_grad(frames: ti.i32):
+    # for all robots, the simulated time steps and the particles each robot uses
+    for r, f, i in ti.ndrange(n_robots, frames, n_particles):
+        if i < robot_n_particles[r]:
+            x.grad[r, f, i] = [0, 0]
+            v.grad[r, f, i] = [0, 0]
+            C.grad[r, f, i] = [[0, 0], [0, 0]]
+            F.grad[r, f, i] = [[0, 0], [0, 0]]
 
 
 @ti.kernel
 def clear_actuation_grad():
-    for t, i in actuation:
-        actuation[t, i] = 0.0
+    for r, t, i in actuation:
+        actuation[r, t, i] = 0.0
+
+
+@ti.func
+def scatter(r, f, nf, p, t):
+    ##P2G of particle p of robot r from frame f, for step t. The new F goes to frame nf
+    base = ti.cast(x[r, f, p] * inv_dx - 0.5, ti.i32)
+    fx = x[r, f, p] * inv_dx - ti.cast(base, ti.i32)
+    w = [0.5 * (1.5 - fx)**2, 0.75 - (fx - 1)**2, 0.5 * (fx - 0.5)**2]
+    new_F = (ti.Matrix.diag(dim=2, val=1) + dt * C[r, f, p]) @ F[r, f, p]
+    J = (new_F).determinant()
+    if particle_type[r, p] == 0:  # fluid
+        sqrtJ = ti.sqrt(J)
+        new_F = ti.Matrix([[sqrtJ, 0], [0, sqrtJ]])
+
+    F[r, nf, p] = new_F
+    r_, s = ti.polar_decompose(new_F)
+
+    act_id = actuator_id[r, p]
+
+    act = actuation[r, t, ti.max(0, act_id)] * act_strength
+    if act_id == -1:
+        act = 0.0
+    # ti.print(act)
+
+    A = ti.Matrix([[0.0, 0.0], [0.0, 1.0]]) * act
+    cauchy = ti.Matrix([[0.0, 0.0], [0.0, 0.0]])
+    mass = 0.0
+    if particle_type[r, p] == 0:
+        mass = 4
+        cauchy = ti.Matrix([[1.0, 0.0], [0.0, 0.1]]) * (J - 1) * E
+    else:
+        if particle_type[r, p] == 2:
+            mass = 0.8##minimum mass
+        elif particle_type[r, p] == 3:  
+            mass = 1.2 ##Heavy mass
+        elif particle_type[r, p] == 4:
+            mass = 1.6
+        elif particle_type[r, p] == 5:
+            mass = 2
+        else:
+            mass = 1
+        cauchy = 2 * mu * (new_F - r_) @ new_F.transpose() + \
+                 ti.Matrix.diag(2, la * (J - 1) * J)
+    cauchy += new_F @ A @ new_F.transpose()
+    stress = -(dt * p_vol * 4 * inv_dx * inv_dx) * cauchy
+    affine = stress + mass * C[r, f, p]
+    for i in ti.static(range(3)):
+        for j in ti.static(range(3)):
+            dpos = (ti.cast(ti.Vector([i, j]), real) - fx) * dx
+            weight = w[i][0] * w[j][1]
+            grid_v_in[r, base[0] + i, base[1] + j] += \
+                weight * (mass * v[r, f, p] + affine @ dpos)
+            grid_m_in[r, base[0] + i, base[1] + j] += weight * mass
 
 
 @ti.kernel
-def p2g(f: ti.i32):
-    for p in range(n_particles):
-        base = ti.cast(x[f, p] * inv_dx - 0.5, ti.i32)
-        fx = x[f, p] * inv_dx - ti.cast(base, ti.i32)
-        w = [0.5 * (1.5 - fx)**2, 0.75 - (fx - 1)**2, 0.5 * (fx - 0.5)**2]
-        new_F = (ti.Matrix.diag(dim=2, val=1) + dt * C[f, p]) @ F[f, p]
-        J = (new_F).determinant()
-        if particle_type[p] == 0:  # fluid
-            sqrtJ = ti.sqrt(J)
-            new_F = ti.Matrix([[sqrtJ, 0], [0, sqrtJ]])
-
-        F[f + 1, p] = new_F
-        r, s = ti.polar_decompose(new_F)
-
-        act_id = actuator_id[p]
-
-        act = actuation[f, ti.max(0, act_id)] * act_strength
-        if act_id == -1:
-            act = 0.0
-        # ti.print(act)
-
-        A = ti.Matrix([[0.0, 0.0], [0.0, 1.0]]) * act
-        cauchy = ti.Matrix([[0.0, 0.0], [0.0, 0.0]])
-        mass = 0.0
-        if particle_type[p] == 0:
-            mass = 4
-            cauchy = ti.Matrix([[1.0, 0.0], [0.0, 0.1]]) * (J - 1) * E
-        else:
-            if particle_type[p] == 2:
-                mass = 0.8##minimum mass
-            elif particle_type[p] == 3:  
-                mass = 1.2 ##Heavy mass
-            elif particle_type[p] == 4:
-                mass = 1.6
-            elif particle_type[p] == 5:
-                mass = 2
-            else:
-                mass = 1
-            cauchy = 2 * mu * (new_F - r) @ new_F.transpose() + \
-                     ti.Matrix.diag(2, la * (J - 1) * J)
-        cauchy += new_F @ A @ new_F.transpose()
-        stress = -(dt * p_vol * 4 * inv_dx * inv_dx) * cauchy
-        affine = stress + mass * C[f, p]
-        for i in ti.static(range(3)):
-            for j in ti.static(range(3)):
-                offset = ti.Vector([i, j])
-                dpos = (ti.cast(ti.Vector([i, j]), real) - fx) * dx
-                weight = w[i][0] * w[j][1]
-                grid_v_in[base +
-                          offset] += weight * (mass * v[f, p] + affine @ dpos)
-                grid_m_in[base + offset] += weight * mass
+def p2g(f: ti.i32, nf: ti.i32, t: ti.i32):
+    for r, p in ti.ndrange(n_robots, n_particles):
+        if p < robot_n_particles[r]:
+            scatter(r, f, nf, p, t)
 
 
 bound = 3
@@ -154,9 +504,9 @@ coeff = 0.5
 
 @ti.kernel
 def grid_op():
-    for i, j in grid_m_in:
-        inv_m = 1 / (grid_m_in[i, j] + 1e-10)
-        v_out = inv_m * grid_v_in[i, j]
+    for r, i, j in grid_m_in:
+        inv_m = 1 / (grid_m_in[r, i, j] + 1e-10)
+        v_out = inv_m * grid_v_in[r, i, j]
         v_out[1] -= dt * gravity
         if i < bound and v_out[0] < 0:
             v_out[0] = 0
@@ -187,120 +537,476 @@ def grid_op():
             v_out[0] = 0
             v_out[1] = 0
 
-        grid_v_out[i, j] = v_out
+        grid_v_out[r, i, j] = v_out
+
+
+@ti.func
+def gather(r, f, nf, p):
+    ##G2P of particle p of robot r, moving it from frame f to frame nf
+    base = ti.cast(x[r, f, p] * inv_dx - 0.5, ti.i32)
+    fx = x[r, f, p] * inv_dx - ti.cast(base, real)
+    w = [0.5 * (1.5 - fx)**2, 0.75 - (fx - 1.0)**2, 0.5 * (fx - 0.5)**2]
+    new_v = ti.Vector([0.0, 0.0])
+    new_C = ti.Matrix([[0.0, 0.0], [0.0, 0.0]])
+
+    for i in ti.static(range(3)):
+        for j in ti.static(range(3)):
+            dpos = ti.cast(ti.Vector([i, j]), real) - fx
+            g_v = grid_v_out[r, base[0] + i, base[1] + j]
+            weight = w[i][0] * w[j][1]
+            new_v += weight * g_v
+            new_C += 4 * weight * g_v.outer_product(dpos) * inv_dx
+
+    v[r, nf, p] = new_v
+    x[r, nf, p] = x[r, f, p] + dt * v[r, nf, p]
+    C[r, nf, p] = new_C
 
 
 @ti.kernel
-def g2p(f: ti.i32):
-    for p in range(n_particles):
-        base = ti.cast(x[f, p] * inv_dx - 0.5, ti.i32)
-        fx = x[f, p] * inv_dx - ti.cast(base, real)
-        w = [0.5 * (1.5 - fx)**2, 0.75 - (fx - 1.0)**2, 0.5 * (fx - 0.5)**2]
-        new_v = ti.Vector([0.0, 0.0])
-        new_C = ti.Matrix([[0.0, 0.0], [0.0, 0.0]])
-
-        for i in ti.static(range(3)):
-            for j in ti.static(range(3)):
-                dpos = ti.cast(ti.Vector([i, j]), real) - fx
-                g_v = grid_v_out[base[0] + i, base[1] + j]
-                weight = w[i][0] * w[j][1]
-                new_v += weight * g_v
-                new_C += 4 * weight * g_v.outer_product(dpos) * inv_dx
-
-        v[f + 1, p] = new_v
-        x[f + 1, p] = x[f, p] + dt * v[f + 1, p]
-        C[f + 1, p] = new_C
+def g2p(f: ti.i32, nf: ti.i32):
+    for r, p in ti.ndrange(n_robots, n_particles):
+        if p < robot_n_particles[r]:
+            gather(r, f, nf, p)
 
 
 @ti.kernel
-def compute_actuation(t: ti.i32):
-    for i in range(n_actuators):
+def g2p_p2g(pf: ti.i32, f: ti.i32, nf: ti.i32, t: ti.i32):
+    ##G2P of step t - 1 from frame pf into frame f and P2G of step t from it, in one pass over the particles.
+    ##Reads grid_v_out and writes grid_v_in and grid_m_in, so one grid is enough. Forward only,
+    ##gradients go through the separate kernels
+    for r, p in ti.ndrange(n_robots, n_particles):
+        if p < robot_n_particles[r]:
+            gather(r, pf, f, p)
+            scatter(r, f, nf, p, t)
+
+
+@ti.kernel
+def compute_actuation(n: ti.i32, saturated: ti.i32):
+    ##Actuation of the first n steps in one launch, saturated up to step saturated
+    for r, t, i in ti.ndrange(n_robots, n, n_actuators):
         act = 999.0
-        if t > 725:
+        if t > saturated:
             act = 0.0
         for j in ti.static(range(n_sin_waves)):
-            act += weights[i, j] * ti.sin(actuation_omega * t * dt +
-                                          2 * math.pi / n_sin_waves * j)
-        act += bias[i]
-        actuation[t, i] = ti.tanh(act)
+            act += weights[r, i, j] * ti.sin(actuation_omega * t * dt +
+                                             2 * math.pi / n_sin_waves * j)
+        act += bias[r, i]
+        actuation[r, t, i] = ti.tanh(act)
         ##################################################################
         ##a(t) = sin(wt)
 
 @ti.kernel
-def compute_x_avg():
-    for i in range(n_particles):
-        contrib = 0.0
-        if particle_type[i] == 1:
-            contrib = 1.0 / n_solid_particles
-        ti.atomic_add(x_avg[None], contrib * x[steps - 1, i])
+def clear_metrics():
+    for r, s in com:
+        com[r, s] = [0, 0]
+        com_v[r, s] = [0, 0]
+    for r, k in metrics:
+        metrics[r, k] = 0
 
 
 @ti.kernel
-def compute_loss():
-    dist = x_avg[None][0]
-    loss[None] = -dist
+def record_com(f: ti.i32, s: ti.i32):
+    ##Centre of mass and mean velocity of the solid particles in frame f, the state after step s. Each thread sums
+    ##a block of metric_block particles in registers and adds it with one atomic instead of one per particle.
+    ##The block is unrolled and masked instead of branching, which Taichi's autodiff needs for the register sums
+    for r, b in ti.ndrange(n_robots, n_particles // metric_block):
+        if b * metric_block < robot_n_particles[r]:
+            pos = ti.Vector([0.0, 0.0])
+            vel = ti.Vector([0.0, 0.0])
+            for k in ti.static(range(metric_block)):
+                p = b * metric_block + k
+                solid = ti.select(p < robot_n_particles[r], 1.0, 0.0) * ti.select(particle_type[r, p] == 1, 1.0, 0.0)
+                pos += solid * x[r, f, p]
+                vel += solid * ti.cast(v[r, f, p], real)
+            com[r, s] += pos / robot_n_solid[r]
+            com_v[r, s] += vel / robot_n_solid[r]
 
 
-@ti.ad.grad_replaced
-def advance(s):
-    clear_grid()
-    compute_actuation(s)
-    p2g(s)
-    grid_op()
-    g2p(s)
+@ti.kernel
+def compute_metrics(n: ti.i32):
+    ##metric_names of every robot over the frames 0 .. n - 1 recorded by record_com() and the n - 1 steps of actuation:
+    ##distance moved in x, mean x velocity, mean squared actuation, mean squared vertical velocity (bounce) and mean
+    ##height of the centre of mass. Steps are summed in blocks like the particles of record_com()
+    for r in range(n_robots):
+        metrics[r, 0] = com[r, n - 1][0] - com[r, 0][0]
+    for r, b in ti.ndrange(n_robots, max_steps // metric_block):
+        if b * metric_block < n:
+            speed = 0.0
+            energy = 0.0
+            bounce = 0.0
+            height = 0.0
+            for k in ti.static(range(metric_block)):
+                s = b * metric_block + k
+                step = ti.select(s >= 1, 1.0, 0.0) * ti.select(s < n, 1.0, 0.0)
+                speed += step * com_v[r, s][0]
+                bounce += step * com_v[r, s][1] ** 2
+                height += step * com[r, s][1]
+                for i in ti.static(range(n_actuators)):
+                    energy += step * actuation[r, ti.max(s - 1, 0), i] ** 2
+            metrics[r, 1] += speed / (n - 1)
+            metrics[r, 2] += energy / ((n - 1) * n_actuators)
+            metrics[r, 3] += bounce / (n - 1)
+            metrics[r, 4] += height / (n - 1)
 
 
-@ti.ad.grad_for(advance)
-def advance_grad(s):
+@ti.kernel
+def compute_loss(n: ti.i32):
+    for r in range(n_robots):
+        l = -com[r, n - 1][0]
+        for k in ti.static(range(len(metric_names))):
+            if ti.static(metric_weights.get(metric_names[k], 0.0)):
+                l += ti.static(metric_weights[metric_names[k]]) * metrics[r, k]
+        robot_loss[r] = l
+        loss[None] += l
+
+
+@ti.kernel
+def upload_scene(robot: ti.i32, n: ti.i32, n_solid: ti.i32, pos: ti.types.ndarray(), aid: ti.types.ndarray(),
+                 ptype: ti.types.ndarray()):
+    ##Frame 0 of one robot slot in a single launch
+    for i in range(n):
+        x[robot, 0, i] = [pos[i, 0], pos[i, 1]]
+        v[robot, 0, i] = [0, 0]
+        C[robot, 0, i] = [[0, 0], [0, 0]]
+        F[robot, 0, i] = [[1, 0], [0, 1]]
+        ##Windowed passes move later states into frame 0 and restore it from here
+        x_ckpt[robot, 0, i] = x[robot, 0, i]
+        v_ckpt[robot, 0, i] = [0, 0]
+        C_ckpt[robot, 0, i] = [[0, 0], [0, 0]]
+        F_ckpt[robot, 0, i] = [[1, 0], [0, 1]]
+        actuator_id[robot, i] = aid[i]
+        particle_type[robot, i] = ptype[i]
+    robot_n_particles[robot] = n
+    robot_n_solid[robot] = n_solid
+
+
+@ti.kernel
+def save_checkpoint(c: ti.i32):
+    for r, p in ti.ndrange(n_robots, n_particles):
+        x_ckpt[r, c, p] = x[r, 0, p]
+        v_ckpt[r, c, p] = v[r, 0, p]
+        C_ckpt[r, c, p] = C[r, 0, p]
+        F_ckpt[r, c, p] = F[r, 0, p]
+
+
+@ti.kernel
+def load_checkpoint(c: ti.i32):
+    for r, p in ti.ndrange(n_robots, n_particles):
+        x[r, 0, p] = x_ckpt[r, c, p]
+        v[r, 0, p] = v_ckpt[r, c, p]
+        C[r, 0, p] = C_ckpt[r, c, p]
+        F[r, 0, p] = F_ckpt[r, c, p]
+
+
+@ti.kernel
+def shift_window(f: ti.i32):
+    ##Frame f, the last one of a full segment, becomes frame 0 of the next one
+    for r, p in ti.ndrange(n_robots, n_particles):
+        x[r, 0, p] = x[r, f, p]
+        v[r, 0, p] = v[r, f, p]
+        C[r, 0, p] = C[r, f, p]
+        F[r, 0, p] = F[r, f, p]
+
+
+@ti.kernel
+def shift_window_grad():
+    ##Gradient reaching frame 0 of a segment belongs to the last frame of the segment before it
+    for r, f, p in x:
+        if f == checkpoint_every:
+            x.grad[r, f, p] = x.grad[r, 0, p]
+            v.grad[r, f, p] = v.grad[r, 0, p]
+            C.grad[r, f, p] = C.grad[r, 0, p]
+            F.grad[r, f, p] = F.grad[r, 0, p]
+    for r, f, p in x:
+        if f < checkpoint_every:
+            x.grad[r, f, p] = [0, 0]
+            v.grad[r, f, p] = [0, 0]
+            C.grad[r, f, p] = [[0, 0], [0, 0]]
+            F.grad[r, f, p] = [[0, 0], [0, 0]]
+
+
+def record_grid(s):
+    if report_grid:
+        count_grid_cells()
+        grid_activity.append((s, grid_cells[0], grid_cells[1]))
+
+
+def simulate(start, f, n, wrap=0, record=False):
+    ##Steps start .. start + n - 1, read from trajectory frames f .. f + n - 1, or from frames cycling
+    ##through 0 .. wrap - 1. The actuation of these steps has to be computed already. With record, the
+    ##centre of mass of every new frame is streamed into com, and of the first frame too when start is 0
+    frame = lambda i: (f + i) % wrap if wrap else f + i
+    if record and start == 0:
+        record_com(frame(0), 0)
+    if not fused_steps:
+        for i in range(n):
+            clear_grid()
+            p2g(frame(i), frame(i + 1), start + i)
+            grid_op()
+            g2p(frame(i), frame(i + 1))
+            record_grid(start + i)
+            if record:
+                record_com(frame(i + 1), start + i + 1)
+        return
     clear_grid()
-    p2g(s)
+    p2g(frame(0), frame(1), start)
+    grid_op()
+    record_grid(start)
+    for i in range(1, n):
+        clear_grid()
+        g2p_p2g(frame(i - 1), frame(i), frame(i + 1), start + i)
+        grid_op()
+        record_grid(start + i)
+        if record:
+            record_com(frame(i), start + i)
+    g2p(frame(n - 1), frame(n))
+    if record:
+        record_com(frame(n), start + n)
+
+
+def step_grad(s, f):
+    ##Backward through step s, its grid is recomputed from frame f first. The gradient of the metrics
+    ##streamed from the step's result, frame f + 1, is added before it flows back into frame f
+    if streaming():
+        record_com.grad(f + 1, s + 1)
+    clear_grid()
+    p2g(f, f + 1, s)
     grid_op()
 
-    g2p.grad(s)
+    g2p.grad(f, f + 1)
     grid_op.grad()
-    p2g.grad(s)
-    compute_actuation.grad(s)
+    p2g.grad(f, f + 1, s)
 
 
-def forward(total_steps=steps):
+@ti.ad.grad_replaced
+def advance(n):
+    simulate(0, 0, n, record=streaming())
+
+
+@ti.ad.grad_for(advance)
+def advance_grad(n):
+    for s in reversed(range(n)):
+        step_grad(s, s)
+
+
+def segments(total_steps, length):
+    ##(segment, first step, step count) of every length-step segment
+    for c, start in enumerate(range(0, total_steps - 1, length)):
+        yield c, start, min(length, total_steps - 1 - start)
+
+
+@ti.ad.grad_replaced
+def advance_segment(c, start, n):
+    if c > 0:
+        shift_window(checkpoint_every)
+        save_checkpoint(c)
+    else:
+        load_checkpoint(0) ##Earlier passes may have left a later state in frame 0
+    simulate(start, 0, n, record=streaming())
+
+
+@ti.ad.grad_for(advance_segment)
+def advance_segment_grad(c, start, n):
+    ##Recompute the segment from its checkpoint, then walk its steps backwards
+    load_checkpoint(c)
+    simulate(start, 0, n)
+    for i in reversed(range(n)):
+        step_grad(start + i, i)
+    shift_window_grad()
+
+
+def forward(total_steps=None):
     # simulation
-    for s in range(total_steps - 1):
-        advance(s)
-    x_avg[None] = [0, 0]
+    if total_steps is None:
+        total_steps = steps
+    assert total_steps <= steps, "Longer runs than steps have to go through render()"
+    compute_actuation(total_steps - 1, int(saturated_share * steps))
+    clear_metrics()
+    if screening:
+        load_checkpoint(0)
+        simulate(0, 0, total_steps - 1, 2, streaming())
+        final = (total_steps - 1) % 2
+    elif checkpoint_every:
+        for c, start, n in segments(total_steps, checkpoint_every):
+            advance_segment(c, start, n)
+        final = n
+    else:
+        advance(total_steps - 1)
+        final = total_steps - 1
+    global last_frame
+    last_frame = final
+    loss[None] = 0
+
+    if streaming():
+        compute_metrics(total_steps)
+    else:
+        record_com(final, total_steps - 1) ##The loss only needs the final centre of mass
+    compute_loss(total_steps)
+
+
+def robot_metrics(n):
+    ##metric_names of the first n robots from the last forward(), as one dict per robot
+    return [dict(zip(metric_names, row)) for row in metrics.to_numpy()[:n].tolist()]
+
+def clear_gradients():
+    ##Only the frames and particles the simulation touched, grid gradients are cleared every step by clear_grid
+    clear_particle_grad(trajectory_frames())
+    for field in (weights, bias, actuation, robot_loss, com, com_v, metrics, loss):
+        field.grad.fill(0)
+
+
+def tape():
+    clear_gradients()
+    return ti.ad.Tape(loss, clear_gradients=False)
+
+def taped_forward():
+    ##forward() and its backward pass, timed apart when profiling. The first pass on new fields counts as jit
+    global fresh_layout
+    phase = 'jit' if fresh_layout else None
+    fresh_layout = False
+    t = tape()
+    with span(phase or 'forward'):
+        t.__enter__()
+        forward()
+    with span(phase or 'backward'):
+        t.__exit__(None, None, None)
+
 
-    compute_x_avg()
-    compute_loss()
+@ti.kernel
+def init_controller(robot: ti.i32, w: ti.types.ndarray(), b: ti.types.ndarray(), wm: ti.types.ndarray(),
+                    ws: ti.types.ndarray(), bm: ti.types.ndarray(), bs: ti.types.ndarray()):
+    ##Weights, bias and optimizer moments of one robot slot
+    for i, j in ti.ndrange(n_actuators, n_sin_waves):
+        weights[robot, i, j] = w[i, j]
+        weights_m[robot, i, j] = wm[i, j]
+        weights_s[robot, i, j] = ws[i, j]
+    for i in range(n_actuators):
+        bias[robot, i] = b[i]
+        bias_m[robot, i] = bm[i]
+        bias_s[robot, i] = bs[i]
+    robot_training[robot] = 1
+
+def controller_state(w=None, b=None):
+    ##(weights, bias, weight moments, bias moments) of a robot slot, fresh random weights by default
+    if w is None:
+        w = np.random.randn(n_actuators, n_sin_waves) * 0.01
+    if b is None:
+        b = np.zeros(n_actuators)
+    zeros = np.zeros((n_actuators, n_sin_waves), dtype=np.float32), np.zeros(n_actuators, dtype=np.float32)
+    return (np.asarray(w, dtype=np.float32), np.asarray(b, dtype=np.float32), zeros[0], zeros[0], zeros[1], zeros[1])
+
+def slot_states(n):
+    ##controller_state() of the first n slots as optimized so far, load_batch() resumes from them
+    fields = [f.to_numpy() for f in (weights, bias, weights_m, weights_s, bias_m, bias_s)]
+    return [tuple(f[r] for f in fields) for r in range(n)]
+
+
+@ti.func
+def optimizer_update(g, m, s, lr, t, method, mom, b1, b2):
+    ##New first and second moments and the step to subtract for gradient g
+    new_m = m
+    new_s = s
+    delta = lr * g
+    if method == 1:
+        new_m = mom * m + g
+        delta = lr * new_m
+    elif method == 2:
+        new_m = b1 * m + (1 - b1) * g
+        new_s = b2 * s + (1 - b2) * g * g
+        m_hat = new_m / (1 - b1**t)
+        s_hat = new_s / (1 - b2**t)
+        delta = lr * m_hat / (ti.sqrt(s_hat) + 1e-8)
+    return ti.Vector([new_m, new_s, delta])
+
+
+@ti.kernel
+def optimizer_step(lr: real, t: ti.i32, method: ti.i32, clip: real, mom: real, b1: real, b2: real):
+    ##One update of weights and bias for every robot still training, method 0 = sgd, 1 = momentum, 2 = adam
+    for r in range(n_robots):
+        if robot_training[r]:
+            norm = 0.0
+            for i in range(n_actuators):
+                for j in ti.static(range(n_sin_waves)):
+                    norm += weights.grad[r, i, j]**2
+                norm += bias.grad[r, i]**2
+            norm = ti.sqrt(norm)
+            scale = 1.0
+            if clip > 0 and norm > clip:
+                scale = clip / norm
+            for i in range(n_actuators):
+                for j in ti.static(range(n_sin_waves)):
+                    u = optimizer_update(weights.grad[r, i, j] * scale, weights_m[r, i, j], weights_s[r, i, j],
+                                         lr, t, method, mom, b1, b2)
+                    weights_m[r, i, j] = u[0]
+                    weights_s[r, i, j] = u[1]
+                    weights[r, i, j] -= u[2]
+                u = optimizer_update(bias.grad[r, i] * scale, bias_m[r, i], bias_s[r, i], lr, t, method, mom, b1, b2)
+                bias_m[r, i] = u[0]
+                bias_s[r, i] = u[1]
+                bias[r, i] -= u[2]
+
+
+def scheduled_lr(iter, iters):
+    if lr_schedule == 'cosine':
+        return learning_rate * 0.5 * (1 + math.cos(math.pi * iter / max(1, iters)))
+    if lr_schedule == 'step':
+        return learning_rate * 0.5**(iter // lr_step)
+    return learning_rate
+
+
+def update_weights(iter, iters):
+    ##Applies the gradients of the last Tape pass to every robot still training in one launch
+    method = ['sgd', 'momentum', 'adam'].index(optimizer)
+    with span('update'):
+        optimizer_step(scheduled_lr(iter, iters), iter + 1, method, grad_clip, momentum, beta1, beta2)
 
 
 class Scene:
     def __init__(self):
+        ##Particles live in the first n_particles rows of preallocated arrays that grow by doubling
         self.n_particles = 0
         self.n_solid_particles = 0
-        self.x = []
-        self.actuator_id = []
-        self.particle_type = []
+        self.x = np.zeros((1024, dim), dtype=np.float64)
+        self.actuator_id = np.zeros(1024, dtype=np.int32)
+        self.particle_type = np.zeros(1024, dtype=np.int32)
         self.offset_x = 0
         self.offset_y = 0
         self.graph = None
+        self.cells = set() ##node_cell() of every node in graph, for O(1) neighbour checks
+        self.curve = [] ##Loss after every optimization iteration, filled by evaluate_batch()
+        self.seconds = 0.0 ##Share of the batch time spent optimizing this robot
+        self.controller = None ##(weights, bias) optimization starts from, None for fresh random weights
+        self.metrics = {} ##metric_names at the last optimization iteration, when they were streamed
+        self.dropped = False ##Stopped by successive halving before the last rung, so never a generation's best
+
+    def add_particles(self, pos, actuation, ptype):
+        n = len(pos)
+        needed = self.n_particles + n
+        if needed > len(self.x):
+            size = max(needed, 2 * len(self.x))
+            self.x = np.concatenate([self.x, np.zeros((size - len(self.x), dim))])
+            self.actuator_id = np.concatenate([self.actuator_id, np.zeros(size - len(self.actuator_id), dtype=np.int32)])
+            self.particle_type = np.concatenate([self.particle_type, np.zeros(size - len(self.particle_type), dtype=np.int32)])
+        self.x[self.n_particles:needed] = pos
+        self.actuator_id[self.n_particles:needed] = actuation
+        self.particle_type[self.n_particles:needed] = ptype
+        self.n_particles = needed
+
+    def sample_grid(self, x, y, w, h):
+        ##Cell centres of the particle lattice over the w x h box at (x, y), column by column
+        w_count = int(w / dx) * particle_density
+        h_count = int(h / dx) * particle_density
+        real_dx = w / w_count
+        real_dy = h / h_count
+        i, j = np.meshgrid(np.arange(w_count), np.arange(h_count), indexing='ij')
+        return x + (i.ravel() + 0.5) * real_dx, y + (j.ravel() + 0.5) * real_dy
 
     def add_rect(self, x, y, w, h, actuation, ptype=1, node=None):
         if ptype == 0:
             assert actuation == -1
-        global n_particles
-        w_count = int(w / dx) * 2
-        h_count = int(h / dx) * 2
-        real_dx = w / w_count
-        real_dy = h / h_count
-        for i in range(w_count):
-            for j in range(h_count):
-                self.x.append([
-                    x + (i + 0.5) * real_dx + self.offset_x,
-                    y + (j + 0.5) * real_dy + self.offset_y
-                ])
-                self.actuator_id.append(actuation)
-                self.particle_type.append(ptype)
-                self.n_particles += 1
-                self.n_solid_particles += int(ptype != 0)##add solid ptypes here
+        px, py = self.sample_grid(x, y, w, h)
+        self.add_particles(np.stack([px + self.offset_x, py + self.offset_y], axis=1), actuation, ptype)
+        self.n_solid_particles += len(px) * int(ptype != 0)##add solid ptypes here
         
         
     def tree_stuff(self, x, y, w, h, actuation, ptype=1, node=0):
@@ -312,37 +1018,29 @@ class Scene:
                 'act': actuation,
                 'ptype': ptype}
         self.graph.append(info)
+        self.cells.add(self.node_cell(x, y, w, h))
+
+    def node_cell(self, x, y, w, h):
+        ##Nodes are placed one width or height away from each other, so they sit on an integer lattice
+        ##of node-sized blocks. Rounding absorbs float error from chains of x += w and x -= w
+        return (int(round(x / w)), int(round(y / h)))
         
         
                 
     def add_circle(self, x, y, w, h, actuation, ptype=1):
         if ptype == 0:
             assert actuation == -1
-        global n_particles
         #print(edge.data)
-        w_count = int(w/dx) * 2
-        h_count = int(h/dx) * 2
-        real_dx = w/w_count
-        real_dy = h/h_count
         cx = x + (w/2)
         cy = y + (h/2)
-        for i in range(w_count):
-            for j in range(h_count):
-                if self.n_particles >= n_particles:
-                        print("Out of particles\n")
-                        return
-                cdx = cx - (x + (i + 0.5) * real_dx)
-                cdy = cy - (y + (j + 0.5) * real_dy)
-                dist = (cdx * cdx + cdy * cdy) ** (1/2)
-                if dist <= (w/2):
-                    self.x.append([
-                    x + (i + 0.5) * real_dx + self.offset_x,
-                    y + (j + 0.5) * real_dy + self.offset_y
-                    ])
-                    self.actuator_id.append(actuation)
-                    self.particle_type.append(ptype)
-                    self.n_particles += 1
-                    self.n_solid_particles += 1 #int(ptype == 1) + int(ptype==2) ##add solid ptypes here
+        px, py = self.sample_grid(x, y, w, h)
+        inside = np.sqrt((cx - px)**2 + (cy - py)**2) <= (w/2)
+        px, py = px[inside], py[inside]
+        if self.n_particles + len(px) > n_particles:
+            print("Out of particles\n")
+            px, py = px[:n_particles - self.n_particles], py[:n_particles - self.n_particles]
+        self.add_particles(np.stack([px + self.offset_x, py + self.offset_y], axis=1), actuation, ptype)
+        self.n_solid_particles += len(px) #int(ptype == 1) + int(ptype==2) ##add solid ptypes here
     
     
     def print_graph(self):
@@ -410,34 +1108,17 @@ class Scene:
         left_mark = node['x'] - node['w'] + 0.035 ##Slightly inside of left side of the base node
         right_mark = node['x'] + node['w'] + 0.035 ##Slightly inside of the right side of the base node
         directions = [1, 2, 3, 4] ##1 = right, 2=left, 3=top, 4=bottom
-        w_count = int(node['w'] / dx) * 2
-        h_count = int(node['h'] / dx) * 2
-        real_dx = node['w'] / w_count
-        real_dy = node['h'] / h_count
-        above=[
-                    node['x'] + (4.5 * real_dx) + self.offset_x,
-                    node['y'] + node['h'] + (4.5 * real_dy) + self.offset_y] 
-        below=[
-                    node['x'] + (4.5 * real_dx) + self.offset_x,
-                    (node['y'] - node['h']) + (4.5 * real_dy) + self.offset_y]
-        if 3 in directions and above in self.x:
+        cx, cy = self.node_cell(node['x'], node['y'], node['w'], node['h'])
+        if 3 in directions and (cx, cy + 1) in self.cells:
             #print('3')
             directions.remove(3)
-        if 4 in directions and below in self.x:
+        if 4 in directions and (cx, cy - 1) in self.cells:
             #print('4')
             directions.remove(4) 
-         
-            
-        right=[
-                    (node['x'] + node['w']) + (4.5 * real_dx) + self.offset_x,
-                    node['y'] + (4.5 * real_dy) + self.offset_y] 
-        left=[
-                    (node['x'] - node['w']) + (4.5 * real_dx) + self.offset_x,
-                    node['y'] + (4.5 * real_dy) + self.offset_y]
-        if 1 in directions and right in self.x:
+        if 1 in directions and (cx + 1, cy) in self.cells:
             #print('1')
             directions.remove(1)
-        if 2 in directions and left in self.x:
+        if 2 in directions and (cx - 1, cy) in self.cells:
             #print('2')
             directions.remove(2)
                     
@@ -464,6 +1145,7 @@ class Scene:
         w = .07
         h = .07
         self.graph = []
+        self.cells = set()
         #self.nx = nx.barbell_graph(2, 3)
         act = 1
         ####################################
@@ -489,8 +1171,8 @@ class Scene:
         self.offset_y = y
 
     def finalize(self):
-        global n_particles, n_solid_particles
-        n_particles = self.n_particles
+        ##Field sizes follow the scene through fit_fields(), only the solid count is kept here
+        global n_solid_particles
         n_solid_particles = self.n_solid_particles
         #print('n_particles', n_particles)
         #print('n_solid', n_solid_particles)
@@ -558,215 +1240,995 @@ def robot(scene):
     #scene.add_rect(0.25, 0.0, 0.05, 0.1, 3) ## Right leg outside
     scene.set_n_actuators(4)
 
-gui = ti.GUI("Differentiable MPM", (640, 640), background_color=0xFFFFFF)
+run_archive = None ##RunArchive every generation is appended to, set by apply_options()
+snapshot = None ##Snapshot the evolution state is saved to, set by apply_options()
+job_queue = None ##Transport robots are sent to for the workers started with -worker, None evaluates them here
+job_retries = 2 ##Times a job is sent again after its worker failed or was lost
+queue_poll = 0.5 ##Seconds between checks of the job queue
+render_mode = 'winner' ##all renders every optimized batch, winner only the best robot of a run, none nothing
+frame_writer = None ##Started on first use so worker processes never create a GUI
 
 
-def visualize(s, folder):
-    aid = actuator_id.to_numpy()
-    colors = np.empty(shape=n_particles, dtype=np.uint32)
-    particles = x.to_numpy()[s]
-    actuation_ = actuation.to_numpy()
-    for i in range(n_particles):
-        color = 0x111111
-        if aid[i] != -1:
-            act = actuation_[s - 1, int(aid[i])]
-            color = ti.rgb_to_hex((0.5 - act, 0.5 - abs(act), 0.5 + act))
-        colors[i] = color
-    gui.circles(pos=particles, color=colors, radius=1.5)
-    gui.line((0.05, 0.02), (0.95, 0.02), radius=3, color=0x0)
+class FrameWriter:
+    ##Draws and encodes frames on a background thread, so the simulation does not wait for the PNG writes.
+    ##The GUI never opens a window, frames only go to disk
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=64)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def run(self):
+        try:
+            gui = ti.GUI("Differentiable MPM", (640, 640), background_color=0xFFFFFF, show_gui=False)
+            while True:
+                job = self.queue.get()
+                if job is None:
+                    return
+                path, particles, colors = job
+                gui.circles(pos=particles, color=colors, radius=1.5)
+                gui.line((0.05, 0.02), (0.95, 0.02), radius=3, color=0x0)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                gui.show(path)
+        except Exception as e:
+            self.error = e ##Raised by the next write, the queue is drained so writers never block
+            while self.queue.get() is not None:
+                pass
+
+    def write(self, path, particles, colors):
+        if self.error:
+            raise self.error
+        self.queue.put((path, particles, colors))
+
+    def close(self):
+        ##Waits until every queued frame is on disk
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error:
+            raise self.error
+
+
+def write_frame(path, particles, colors):
+    global frame_writer
+    if frame_writer is None:
+        frame_writer = FrameWriter()
+    frame_writer.write(path, particles, colors)
+
+def finish_frames():
+    ##Blocks until every frame written so far is on disk, the next write starts a new writer
+    global frame_writer
+    if frame_writer is not None:
+        writer, frame_writer = frame_writer, None
+        writer.close()
 
-    os.makedirs(folder, exist_ok=True)
-    gui.show(f'{folder}/{s:04d}.png')
 
-def generate(r, robots, iters, allocate=False, mutation=False):
-    ##Initial generation and initializing fields 
+@ti.kernel
+def export_frames(robot: ti.i32, n: ti.i32, frames: ti.types.ndarray(), out: ti.types.ndarray()):
+    ##Copies the positions of the first n particles at the given trajectory frames, nothing else leaves the device
+    for k, i in ti.ndrange(frames.shape[0], n):
+        out[k, i, 0] = x[robot, frames[k], i][0]
+        out[k, i, 1] = x[robot, frames[k], i][1]
+
+
+def frame_colors(aid, act, s):
+    ##Actuated particles are shaded by the actuation of step s - 1, the rest is dark grey
+    a = act[s - 1, np.maximum(aid, 0)]
+    colors = ti.rgb_to_hex((0.5 - a, 0.5 - np.abs(a), 0.5 + a))
+    return np.where(aid != -1, colors, 0x111111).astype(np.uint32)
+
+
+def render(total_steps, folder, n_loaded):
+    ##Simulates total_steps and draws every 16th step of each loaded robot. The trajectory fields
+    ##may hold fewer frames than total_steps, so steps are exported as each window of frames is simulated
+    with span('render'):
+        frames = range(15, total_steps, 16)
+        window = trajectory_frames() - 1
+        aid = actuator_id.to_numpy()
+        counts = robot_n_particles.to_numpy()
+        compute_actuation(total_steps - 1, int(saturated_share * steps)) ##Longer than steps, so the same steps as forward()
+        load_checkpoint(0)
+        for c, start, n in segments(total_steps, window):
+            if c > 0:
+                shift_window(window)
+            simulate(start, 0, n)
+            wanted = [s for s in frames if start < s <= start + n]
+            if not wanted:
+                continue
+            act = actuation.to_numpy()
+            for r in range(n_loaded):
+                pos = np.empty((len(wanted), counts[r], 2), dtype=np.float32)
+                export_frames(r, counts[r], np.array([s - start for s in wanted], dtype=np.int32), pos)
+                for k, s in enumerate(wanted):
+                    write_frame(f'{folder}/{s:04d}.png', pos[k], frame_colors(aid[r, :counts[r]], act[r], s))
+        load_checkpoint(0) ##Later passes start from the loaded state again
+
+def replay(scene, w, b, total_steps, folder):
+    ##Renders a robot with an already optimized controller instead of optimizing it again
+    fit_fields([scene])
+    load_batch([scene], [controller_state(w, b)])
+    render(total_steps, folder, 1)
+
+def set_n_robots(n):
+    ##Batch size, has to be set before allocate_fields()
+    global n_robots
+    n_robots = n
+
+def load_scene(scene, robot=0, state=None):
+    ##Copy a finalized scene into a robot slot with the controller_state() state, by default the scene's
+    ##controller or fresh random weights
+    assert scene.n_particles <= n_particles, "Robot does not fit in the allocated fields"
+    if state is None:
+        state = controller_state(*scene.controller) if scene.controller else controller_state()
+    init_controller(robot, *state)
+    upload_particles(scene, robot)
+
+def upload_particles(scene, robot):
+    n = scene.n_particles
+    order = particle_permutation(scene.x[:n])
+    upload_scene(robot, n, scene.n_solid_particles, scene.x[:n][order].astype(np.float32),
+                 scene.actuator_id[:n][order], scene.particle_type[:n][order])
+
+def particle_permutation(pos):
+    ##Particle order for particle_order: by the Morton code or the row-major index of each particle's grid cell,
+    ##so particles that scatter to and gather from the same cells are next to each other in memory
+    if particle_order == 'none':
+        return np.arange(len(pos))
+    cell = np.clip((pos * inv_dx).astype(np.int64), 0, n_grid - 1)
+    if particle_order == 'rows':
+        key = cell[:, 0] * n_grid + cell[:, 1]
+    else:
+        key = np.zeros(len(pos), dtype=np.int64)
+        for bit in range(max(1, n_grid - 1).bit_length()):
+            key |= ((cell[:, 0] >> bit) & 1) << (2 * bit + 1) | ((cell[:, 1] >> bit) & 1) << (2 * bit)
+    return np.argsort(key, kind='stable')
+
+@ti.kernel
+def permute_particles(robot: ti.i32, n: ti.i32, order: ti.types.ndarray(), aid: ti.types.ndarray(),
+                      ptype: ti.types.ndarray()):
+    ##Reorders the loaded state of one robot, so a whole trajectory and its gradients use the same order
+    for i in range(n):
+        j = order[i]
+        x[robot, 0, i] = x_ckpt[robot, 0, j]
+        v[robot, 0, i] = v_ckpt[robot, 0, j]
+        C[robot, 0, i] = C_ckpt[robot, 0, j]
+        F[robot, 0, i] = F_ckpt[robot, 0, j]
+        actuator_id[robot, i] = aid[j]
+        particle_type[robot, i] = ptype[j]
+    for i in range(n):
+        x_ckpt[robot, 0, i] = x[robot, 0, i]
+        v_ckpt[robot, 0, i] = v[robot, 0, i]
+        C_ckpt[robot, 0, i] = C[robot, 0, i]
+        F_ckpt[robot, 0, i] = F[robot, 0, i]
+
+def resort_particles(n_loaded):
+    ##Sorts the particles of every loaded robot by where they were at the end of the last pass. Only the
+    ##order between passes changes, the loaded state itself stays the same. With checkpointing the backward
+    ##pass leaves the first segment in the window, so its positions at last_frame are used instead
+    counts = robot_n_particles.to_numpy()
+    aid, ptype = actuator_id.to_numpy(), particle_type.to_numpy()
+    for r in range(n_loaded):
+        if counts[r] == 0:
+            continue
+        pos = np.empty((1, counts[r], 2), dtype=np.float32)
+        export_frames(r, counts[r], np.array([last_frame], dtype=np.int32), pos)
+        permute_particles(r, counts[r], particle_permutation(pos[0]).astype(np.int32), aid[r, :counts[r]],
+                          ptype[r, :counts[r]])
+
+def load_batch(scenes, states=None):
+    ##Fill the first len(scenes) slots, unused slots are emptied so they cost nothing
+    assert len(scenes) <= n_robots, "More robots than the allocated batch size"
+    with span('upload'):
+        for r in range(n_robots):
+            if r < len(scenes):
+                load_scene(scenes[r], r, states[r] if states else None)
+            else:
+                robot_n_particles[r] = 0
+                robot_n_solid[r] = 0
+                robot_training[r] = 0
+
+def evaluate_batch(scenes, iters, render_steps, states=None, first=0, total=None):
+    ##Optimizes every scene at once, one robot per slot, and returns their final losses.
+    ##With patience set, a robot whose loss plateaus stops training and is dropped from the simulation.
+    ##states resumes robots from slot_states(), the iterations are then first .. first + iters - 1 of a
+    ##total iteration run for the learning rate schedule
+    if total is None:
+        total = iters
+    started = time.perf_counter()
+    fit_fields(scenes)
+    load_batch(scenes, states)
+    losses = [None] * len(scenes)
+    best = [math.inf] * len(scenes)
+    stale = [0] * len(scenes)
+    training = [True] * len(scenes)
+    trained = [0] * len(scenes)
+    for iter in range(iters):
+        taped_forward()
+        current = robot_loss.to_numpy()
+        measured = robot_metrics(len(scenes)) if streaming() else None
+        for r in range(len(scenes)):
+            if not training[r]:
+                continue
+            losses[r] = float(current[r])
+            scenes[r].curve.append(losses[r])
+            if measured:
+                scenes[r].metrics = measured[r]
+            trained[r] += 1
+            if losses[r] < best[r] - tolerance:
+                best[r] = losses[r]
+                stale[r] = 0
+            else:
+                stale[r] += 1
+            if patience and stale[r] >= patience:
+                training[r] = False
+                robot_training[r] = 0
+                robot_n_particles[r] = 0
+        #print('i=', iter, 'loss=', losses)
+        update_weights(first + iter, total)
+        if not any(training):
+            break
+        if resort_every and particle_order != 'none' and (iter + 1) % resort_every == 0:
+            with span('sort'):
+                resort_particles(len(scenes))
+    if report_grid:
+        print_grid_report()
+    ##The batch time is split by particles times iterations, which is what the kernels scale with
+    seconds = time.perf_counter() - started
+    work = [scene.n_particles * n for scene, n in zip(scenes, trained)]
+    for scene, n, w in zip(scenes, trained, work):
+        share = seconds * w / max(1, sum(work))
+        scene.seconds += share
+        if profiling:
+            profile_robots.append({'nodes': len(scene.graph), 'particles': scene.n_particles, 'iterations': n,
+                                   'batch': len(scenes), 'seconds': share})
+
+    if iters and render_steps:
+        # visualize
+        for r in range(len(scenes)):
+            upload_particles(scenes[r], r)
+        render(render_steps, 'diffmpm/iter{:03d}'.format(total - 1), len(scenes))
+    return losses
+
+def screen(scenes):
+    ##Losses of scenes with their fresh random weights from a single forward pass, without the tape and with
+    ##two frames per robot, so large candidate pools fit in one batch. The batch settings are restored after.
+    ##Scenes without a controller keep the weights they were screened with, optimization starts from them
+    global screening, n_robots
+    for scene in scenes:
+        if scene.controller is None:
+            state = controller_state()
+            scene.controller = (state[0].tolist(), state[1].tolist())
+    settings = (screening, n_robots)
+    screening, n_robots = True, max(len(scenes), 1)
+    try:
+        fit_fields(scenes)
+        load_batch(scenes)
+        with span('screen'):
+            forward()
+        return [float(l) for l in robot_loss.to_numpy()[:len(scenes)]]
+    finally:
+        screening, n_robots = settings
+
+def shortlist(scenes, keep):
+    ##The keep scenes with the lowest screening loss, in their original order
+    if keep >= len(scenes):
+        return scenes
+    losses = screen(scenes)
+    best = sorted(np.argsort(losses, kind='stable')[:keep])
+    return [scenes[i] for i in best]
+
+def precision_report(scenes):
+    ##Compares one Tape pass with the current trajectory precision against f32 on the same robots and weights:
+    ##losses, controller gradients and trajectory memory, printed to stderr and returned as a dict
+    global trajectory_precision
+    precision = trajectory_precision
+    names = ['x', 'v', 'C', 'F', 'x_ckpt', 'v_ckpt', 'C_ckpt', 'F_ckpt']
+    runs = {}
+    states = None
+    try:
+        for p in ['f32', precision]:
+            trajectory_precision = p
+            fit_fields(scenes)
+            load_batch(scenes, states)
+            states = states or slot_states(len(scenes))
+            taped_forward()
+            n = len(scenes)
+            grads = np.concatenate([weights.grad.to_numpy()[:n].reshape(n, -1), bias.grad.to_numpy()[:n]], axis=1)
+            memory = sum(size for name, shape, size in field_bytes() if name in names)
+            runs[p] = (robot_loss.to_numpy()[:n].astype(np.float64), grads.astype(np.float64), memory)
+    finally:
+        trajectory_precision = precision
+    (loss32, grad32, memory32), (loss, grad, memory) = runs['f32'], runs[precision]
+    cosine = (grad * grad32).sum(1) / np.maximum(np.linalg.norm(grad, axis=1) * np.linalg.norm(grad32, axis=1), 1e-30)
+    error = np.linalg.norm(grad - grad32, axis=1) / np.maximum(np.linalg.norm(grad32, axis=1), 1e-30)
+    report = {'precision': precision, 'loss_f32': loss32.tolist(), 'loss': loss.tolist(),
+              'loss_error': np.abs(loss - loss32).tolist(), 'grad_cosine': cosine.tolist(),
+              'grad_relative_error': error.tolist(), 'trajectory_mb_f32': memory32 / 2**20,
+              'trajectory_mb': memory / 2**20}
+    print('Trajectory precision {} against f32: {:.1f} MB instead of {:.1f} MB (trajectory fields with gradients)'.format(
+        precision, report['trajectory_mb'], report['trajectory_mb_f32']), file=sys.stderr)
+    for r in range(len(scenes)):
+        print('  robot {}: loss {:.6f} vs {:.6f} (error {:.2e}), gradient cosine {:.4f}, relative error {:.2e}'.format(
+            r, loss[r], loss32[r], abs(loss[r] - loss32[r]), cosine[r], error[r]), file=sys.stderr)
+    return report
+
+def iterations_to(curve, target):
+    ##Optimization iterations before the loss first came within tolerance of target, None if it never did
+    return next((i for i, l in enumerate(curve) if l <= target + tolerance), None)
+
+def warm_start_report(robot, control, mutations, iters, batch=1):
+    ##Optimizes the same mutations mutants of robot from fresh random weights (cold) and from control, robot's
+    ##optimized (weights, bias) (warm). Prints to stderr how many iterations each start needed to reach the best
+    ##loss of the cold start, and returns the numbers of every mutant as a dict
+    mutants = [mutant_scene(robot).graph for i in range(mutations)]
+    curves = {}
+    for start_from in ['cold', 'warm']:
+        scenes = [stored_scene(graph, inherited_controller(robot, control) if start_from == 'warm' else None)
+                  for graph in mutants]
+        for start in range(0, len(scenes), batch):
+            evaluate_batch(scenes[start:start + batch], iters, 0)
+        curves[start_from] = [scene.curve for scene in scenes]
+    report = {'iters': iters, 'target': [], 'cold': [], 'warm': [], 'cold_loss': [], 'warm_loss': []}
+    for cold, warm in zip(curves['cold'], curves['warm']):
+        report['target'].append(min(cold))
+        report['cold'].append(iterations_to(cold, min(cold)))
+        report['warm'].append(iterations_to(warm, min(cold)))
+        report['cold_loss'].append(cold[-1])
+        report['warm_loss'].append(warm[-1])
+    reached = [n for n in report['warm'] if n is not None]
+    print('Warm start over {} mutants: the best cold loss within {} iterations took {:.1f} iterations cold and '
+          '{} warm, reached by {} of {} warm mutants'.format(
+              mutations, iters, np.mean(report['cold']), '{:.1f}'.format(np.mean(reached)) if reached else '-',
+              len(reached), mutations), file=sys.stderr)
+    for r in range(mutations):
+        print('  mutant {}: target {:.4f}, cold {} iterations (final {:.4f}), warm {} iterations (final {:.4f}, '
+              'first {:.4f})'.format(r, report['target'][r], report['cold'][r], report['cold_loss'][r],
+                                     '-' if report['warm'][r] is None else report['warm'][r], report['warm_loss'][r],
+                                     curves['warm'][r][0]), file=sys.stderr)
+    return report
+
+def promote(scenes, keep, iters, batch=1):
+    ##The keep scenes with the lowest loss after optimizing all of them at coarse_fidelity, in their original
+    ##order. Coarse results are not cached or rendered, the kept scenes are evaluated again at full fidelity
+    if keep >= len(scenes):
+        return scenes
+    losses = []
+    with fidelity(coarse_fidelity):
+        coarse = [stored_scene(scene.graph, scene.controller) for scene in scenes]
+        for start in range(0, len(coarse), batch):
+            losses += evaluate_batch(coarse[start:start + batch], iters, 0)
+    best = sorted(np.argsort(losses, kind='stable')[:keep])
+    return [scenes[i] for i in best]
+
+def random_scene(r):
     scene = Scene()
     scene.set_offset(0.02, 0.03)
-    scene.generate_robot(r) ##Generate random robot with r nodes
+    with span('scene'):
+        scene.generate_robot(r) ##Generate random robot with r nodes
     scene.finalize()
-    #Runnning velocity loss function below
-    if allocate:
-        allocate_fields()
-    for i in range(n_actuators):
-        for j in range(n_sin_waves):
-            weights[i, j] = np.random.randn() * 0.01
-
-    for i in range(scene.n_particles):
-        x[0, i] = scene.x[i]
-        F[0, i] = [[1, 0], [0, 1]]
-        actuator_id[i] = scene.actuator_id[i]
-        particle_type[i] = scene.particle_type[i]
+    return scene
 
-    losses = []
-    for iter in range(iters):
-        with ti.ad.Tape(loss):
-            forward()
-        l = loss[None]
-        losses.append(l)
-        #print('i=', iter, 'loss=', l)
-        learning_rate = 0.1
-    
-        for i in range(n_actuators):
-            for j in range(n_sin_waves):
-                # print(weights.grad[i, j])
-                weights[i, j] -= learning_rate * weights.grad[i, j]
-            bias[i] -= learning_rate * bias.grad[i]
-    
-        if iter == iters - 1:
-            # visualize
-           
-            robots.append(scene.graph)
-            forward(1532)
-            for s in range(15, 1532, 16):
-                visualize(s, 'diffmpm/iter{:03d}'.format(iter))
-            #print(scene.graph)###################################
-    return robots, l
-        
-def rebuild_and_mutate(robot, iters, mutants, r):
+def mutant_scene(robot, control=None):
+    ##With warm_start, a mutant of a robot with known optimized (weights, bias) control starts from them
     scene = Scene()
     scene.set_offset(0.02, 0.03)
     scene.graph = []
-    scene.rebuild(robot)
+    with span('scene'):
+        scene.rebuild(robot) ##Rebuild previous robot and add a node
     scene.finalize()
+    if control and warm_start:
+        scene.controller = inherited_controller(robot, control)
+    return scene
 
-    for i in range(n_actuators):
-        for j in range(n_sin_waves):
-            weights[i, j] = np.random.randn() * 0.01
-
-    for i in range(scene.n_particles):
-        x[0, i] = scene.x[i]
-        F[0, i] = [[1, 0], [0, 1]]
-        actuator_id[i] = scene.actuator_id[i]
-        particle_type[i] = scene.particle_type[i]
-    losses = []
-    for iter in range(iters):
-        with ti.ad.Tape(loss):
-            forward()
-        l = loss[None]
-        losses.append(l)
-        #print('i=', iter, 'loss=', l)
-        learning_rate = 0.1
-    
-        for i in range(n_actuators):
-            for j in range(n_sin_waves):
-                weights[i, j] -= learning_rate * weights.grad[i, j]
-            bias[i] -= learning_rate * bias.grad[i]
-    
-        if iter == iters - 1:
-            # visualize
-         
-            mutants.append(scene.graph)
-            forward(1500)
-            for s in range(15, 1500, 16):
-                visualize(s, 'diffmpm/iter{:03d}'.format(iter))
-            #print(scene.graph) #################################
-    return mutants, l
-
-def view(robot, iters):
+def stored_scene(robot, control=None):
     scene = Scene()
     scene.set_offset(0.02, 0.03)
     scene.graph = []
-    scene.rebuildview(robot)
+    with span('scene'):
+        scene.rebuildview(robot)
     scene.finalize()
+    scene.controller = control
+    return scene
+
+def inherited_controller(parent, control):
+    ##Starting (weights, bias) of a mutant of parent. Actuator ids are shared between a robot and its mutants,
+    ##so the rows of every actuator the parent drives are copied. Actuators only the new node drives start
+    ##from fresh random weights and zero bias, like controller_state()
+    w, b = controller_state()[:2]
+    for a in {node['act'] for node in parent if 0 <= node['act'] < min(n_actuators, len(control[0]))}:
+        w[a] = control[0][a]
+        b[a] = control[1][a]
+    return w.tolist(), b.tolist()
+
+def evaluate_morphology(robot, iters, config=None, control=None):
+    ##Worker entry point: rebuild a stored morphology, optimize it from control, (weights, bias) or None
+    ##for fresh random weights, and return its loss and graph
+    if config:
+        set_config(config) ##Each worker process sizes its own fields from the robots it gets
+    scene = stored_scene(robot, control)
+    losses = evaluate_batch([scene], iters, 0)
+    w, b = controller(0)
+    return losses[0], scene.graph, w, b, scene.curve, scene.seconds, scene.metrics
+
+def pool_size(jobs, workers=0):
+    ##Workers and Taichi threads per worker so every core is used once, workers=0 means one per core
+    if hasattr(os, 'sched_getaffinity'):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    if workers <= 0:
+        workers = cores
+    workers = max(1, min(workers, jobs))
+    threads = max(1, cores // workers)
+    return workers, threads
+
+@contextlib.contextmanager
+def worker_threads(threads):
+    ##Taichi threads of the worker processes started inside the block
+    old_threads = os.environ.get('TI_CPU_MAX_NUM_THREADS')
+    os.environ['TI_CPU_MAX_NUM_THREADS'] = str(threads) ##Picked up by ti.init when a worker imports this file
+    try:
+        yield
+    finally:
+        if old_threads is None:
+            del os.environ['TI_CPU_MAX_NUM_THREADS']
+        else:
+            os.environ['TI_CPU_MAX_NUM_THREADS'] = old_threads
+
+def evaluate_job(job):
+    ##(index, evaluate_morphology() result) of an (index, robot, iters, config, control) job
+    return job[0], evaluate_morphology(*job[1:])
+
+def evaluate_pool(robots, iters, workers=0, controllers=None):
+    ##Optimizes every morphology in its own process, each with its own Taichi runtime and fields,
+    ##starting from controllers[i] or fresh random weights. Yields (index, result) as the robots finish
+    workers, threads = pool_size(len(robots), workers)
+    controllers = controllers or [None] * len(robots)
+    jobs = [(i, robot, iters, get_config(), control) for i, (robot, control) in enumerate(zip(robots, controllers))]
+    with worker_threads(threads):
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(workers) as pool:
+            yield from pool.imap_unordered(evaluate_job, jobs)
+
+def evaluate_queue(robots, iters, controllers=None):
+    ##Sends every morphology to the workers of job_queue and yields (index, evaluate_morphology() result) as
+    ##they finish
+    controllers = controllers or [None] * len(robots)
+    queued = QueueJobs(job_queue, job_retries)
+    for i, (robot, control) in enumerate(zip(robots, controllers)):
+        queued.submit(i, (robot, iters, get_config(), control))
+    while queued.jobs:
+        yield from queued.finished()
+        if queued.jobs:
+            time.sleep(queue_poll)
+
+def controller(robot):
+    ##Optimized weights and bias of a robot slot as plain lists
+    return weights.to_numpy()[robot].tolist(), bias.to_numpy()[robot].tolist()
+
+
+##Settings the loss of an optimized robot depends on, fitness cache entries are only reused under the same ones
+cache_names = ['n_grid', 'particle_density', 'steps', 'trajectory_precision', 'optimizer', 'learning_rate', 'lr_schedule',
+               'lr_step', 'momentum', 'beta1', 'beta2', 'grad_clip', 'patience', 'tolerance', 'metric_weights']
+
+def cache_setup(control=None):
+    ##The settings of cache_names and whether the robot starts from a controller or fresh random weights
+    setup = {name: globals()[name] for name in cache_names}
+    setup['warm'] = control is not None
+    return setup
+
+def resumed_scenes(kind, iters):
+    ##Scenes of the unfinished generation of this kind in the snapshot, None when there is none to resume
+    resumed = snapshot.resumed(kind, iters) if snapshot else None
+    if resumed is None:
+        return None
+    return [stored_scene(robot, control) for robot, control in zip(*resumed)]
+
+def evaluate_scenes(scenes, iters, batch=1, workers=1, render_steps=0, cache=None):
+    ##Losses and optimized (weights, bias) of all scenes, taken from the cache where possible. The rest
+    ##is optimized in batches of batch robots, on a pool when workers != 1 or by the workers of job_queue,
+    ##and stored in the cache.
+    ##Batches are only rendered with render_mode all. Robots the snapshot already holds results of are not
+    ##evaluated again, the others are added to it as they finish
+    losses = [None] * len(scenes)
+    controllers = [None] * len(scenes)
+    misses = []
+    resumed = snapshot.finished(scenes, iters) if snapshot else {}
+    for i, scene in enumerate(scenes):
+        if i in resumed:
+            losses[i], controllers[i], scene.curve, scene.seconds, scene.metrics = resumed[i]
+            continue
+        hit = cache.lookup(scene.graph, iters, cache_setup(scene.controller)) if cache else None
+        if hit is None:
+            misses.append(i)
+        else:
+            losses[i] = hit[0]
+            controllers[i] = hit[1:]
+    if (workers != 1 or job_queue) and misses:
+        robots, starts = [scenes[i].graph for i in misses], [scenes[i].controller for i in misses]
+        if job_queue:
+            results = evaluate_queue(robots, iters, starts)
+        else:
+            results = evaluate_pool(robots, iters, workers, starts)
+        for r, (l, robot, w, b, curve, seconds, metrics) in results:
+            i = misses[r]
+            losses[i] = l
+            controllers[i] = (w, b)
+            scenes[i].curve, scenes[i].seconds, scenes[i].metrics = curve, seconds, metrics
+            if snapshot:
+                snapshot.add_result(i, scenes[i], l, controllers[i])
+                snapshot.save()
+    else:
+        if render_mode != 'all':
+            render_steps = 0
+        if halving and len(misses) > 1 and iters > 1:
+            chunk_losses, chunk_controllers, winner = successive_halving([scenes[i] for i in misses], iters, batch,
+                                                                         render_steps)
+            for r, i in enumerate(misses):
+                losses[i] = chunk_losses[r]
+                controllers[i] = chunk_controllers[r]
+                scenes[i].dropped = r != winner
+            misses = [misses[winner]] ##The others were not trained for all iterations, so they are not cached
+        else:
+            for start in range(0, len(misses), batch):
+                chunk = misses[start:start + batch]
+                chunk_losses = evaluate_chunk([scenes[i] for i in chunk], iters, render_steps)
+                for r, i in enumerate(chunk):
+                    losses[i] = chunk_losses[r]
+                    controllers[i] = controller(r)
+                    if snapshot:
+                        snapshot.add_result(i, scenes[i], losses[i], controllers[i])
+                if snapshot:
+                    snapshot.save()
+    if cache:
+        for i in misses + [i for i in resumed if scenes[i].curve]: ##Results of the interrupted run may not be saved yet
+            cache.store(scenes[i].graph, iters, cache_setup(scenes[i].controller), losses[i], *controllers[i])
+    return losses, controllers
+
+def evaluate_chunk(scenes, iters, render_steps):
+    ##evaluate_batch() of one batch, optimized snapshot.every iterations at a time and saved to the snapshot in
+    ##between, resuming the saved batch if it holds these scenes. Patience keeps its counts within one
+    ##evaluate_batch(), so with patience set the batch is only saved when it finishes
+    if not snapshot or not snapshot.every or patience:
+        return evaluate_batch(scenes, iters, render_steps)
+    first, states = snapshot.saved_batch(scenes) or (0, None)
+    while True:
+        length = min(snapshot.every, iters - first)
+        losses = evaluate_batch(scenes, length, render_steps if first + length >= iters else 0, states, first, iters)
+        first += length
+        if first >= iters:
+            return losses
+        states = slot_states(len(scenes))
+        snapshot.save_batch(scenes, first, states)
+
+def halving_rungs(n, iters):
+    ##(robots, iterations) of every rung for n robots, down to a single one. Rungs get equal shares of the
+    ##iters iterations the winner is trained for, at least one each, so with fewer iters than rungs the last
+    ##rungs are merged and the final one keeps the single best robot
+    assert halving >= 2, "Successive halving has to drop robots after every rung"
+    assert iters >= 2, "Successive halving needs an iteration per rung"
+    alive = [n]
+    while alive[-1] > 1:
+        alive.append(-(-alive[-1] // halving))
+    if len(alive) > iters:
+        alive = alive[:iters - 1] + [1]
+    length = iters // len(alive)
+    lengths = [length] * (len(alive) - 1) + [iters - length * (len(alive) - 1)]
+    return list(zip(alive, lengths))
+
+def successive_halving(scenes, iters, batch=1, render_steps=0):
+    ##Optimizes scenes rung by rung. After each rung the robots with the lowest losses go on from their weights,
+    ##bias and optimizer moments and the rest stop. Returns the losses and controllers of every scene from the
+    ##last rung it was trained in and the index of the winner, the only scene trained in every rung
+    rungs = halving_rungs(len(scenes), iters)
+    losses = [None] * len(scenes)
+    states = [None] * len(scenes)
+    alive = list(range(len(scenes)))
+    first = 0
+    for k, (count, length) in enumerate(rungs):
+        alive = sorted(sorted(alive, key=lambda i: losses[i])[:count]) if k else alive
+        for start in range(0, len(alive), batch):
+            chunk = alive[start:start + batch]
+            drawn = render_steps if k == len(rungs) - 1 else 0
+            chunk_losses = evaluate_batch([scenes[i] for i in chunk], length, drawn, [states[i] for i in chunk], first, iters)
+            chunk_states = slot_states(len(chunk))
+            for r, i in enumerate(chunk):
+                losses[i] = chunk_losses[r]
+                states[i] = chunk_states[r]
+        first += length
+    ##stderr, stdout only holds the best robot and its loss
+    print('Successive halving: {} rungs of {} robots, {} robot iterations instead of {}'.format(
+        len(rungs), [count for count, length in rungs], sum(count * length for count, length in rungs),
+        len(scenes) * iters), file=sys.stderr)
+    return losses, [(state[0].tolist(), state[1].tolist()) for state in states], alive[0]
+
+
+def view(robot, iters, control=None):
+    scene = stored_scene(robot, control)
     #print(robot)
-
-    for i in range(n_actuators):
-        for j in range(n_sin_waves):
-            weights[i, j] = np.random.randn() * 0.01
-
-    for i in range(scene.n_particles):
-        #print(x[0, i])
-        #print(scene.x[i])
-        x[0, i] = scene.x[i]
-        F[0, i] = [[1, 0], [0, 1]]
-        actuator_id[i] = scene.actuator_id[i]
-        particle_type[i] = scene.particle_type[i]
+    fit_fields([scene])
+    load_batch([scene])
     #print("PLEASE")
     losses = []
     for iter in range(iters):
-        with ti.ad.Tape(loss):
-            forward()
-        l = loss[None]
+        taped_forward()
+        l = robot_loss[0]
         losses.append(l)
         #print('i=', iter, 'loss=', l)
-        learning_rate = 0.1
-    
-        for i in range(n_actuators):
-            for j in range(n_sin_waves):
-                # print(weights.grad[i, j])
-                weights[i, j] -= learning_rate * weights.grad[i, j]
-            bias[i] -= learning_rate * bias.grad[i]
+        update_weights(iter, iters)
     
         if iter % 10 == 0:
             # visualize
-            forward(1500)
-            for s in range(15, 1500, 16):
-                visualize(s, 'diffmpm/iter{:03d}'.format(iter))
-    
+            render(1500, 'diffmpm/iter{:03d}'.format(iter), 1)
+    if profiling:
+        write_profile('view')
+
+def metric_weight_list(text):
+    ##name=weight,... of --metric-weights
+    weights = {}
+    for item in filter(None, text.split(',')):
+        name, weight = item.split('=')
+        if name not in metric_names:
+            raise argparse.ArgumentTypeError('unknown metric {}, expected one of {}'.format(name, ', '.join(metric_names)))
+        weights[name] = float(weight)
+    return weights
+
+def halving_rate(text):
+    ##n of --halving, 0 or at least 2 since every rung has to drop robots
+    n = int(text)
+    if n == 1 or n < 0:
+        raise argparse.ArgumentTypeError('expected 0 (off) or at least 2, got {}'.format(n))
+    return n
+
+def add_options(parser):
+    ##Simulation and optimization options, shared with control.py
+    parser.add_argument('--iters', type=int, default=10)
+    parser.add_argument('--batch', type=int, default=1) ##Robots simulated together in one set of kernels
+    parser.add_argument('--workers', type=int, default=1) ##Worker processes, 0 = one per core, 1 = evaluate in this process
+    parser.add_argument('--checkpoint', type=int, default=0) ##Steps between trajectory checkpoints, 0 = keep every frame, -1 = sqrt(steps)
+    parser.add_argument('--memory-report', action="store_true") ##Print the bytes allocated per field to stderr
+    parser.add_argument('--optimizer', choices=['sgd', 'momentum', 'adam'], default=optimizer)
+    parser.add_argument('--lr', type=float, default=learning_rate)
+    parser.add_argument('--lr-schedule', choices=['constant', 'cosine', 'step'], default=lr_schedule)
+    parser.add_argument('--clip', type=float, default=grad_clip) ##Largest gradient norm per robot, 0 = no clipping
+    parser.add_argument('--patience', type=int, default=patience) ##Iterations without improvement before a robot stops, 0 = never
+    parser.add_argument('--tol', type=float, default=tolerance) ##Smallest loss decrease that counts as improvement
+    parser.add_argument('--cache', default='fitness_cache.json') ##Fitness cache file, '' disables the cache
+    parser.add_argument('--cache-size', type=int, default=1000) ##Most morphologies kept in the cache
+    parser.add_argument('--archive', default='runs.sqlite') ##Archive of every evaluated robot, '' disables it
+    parser.add_argument('--render', choices=['all', 'winner', 'none'], default=render_mode) ##Which optimized robots are drawn to diffmpm/
+    parser.add_argument('--n-grid', type=int, default=n_grid) ##Grid cells per side, particles are sampled at 2 per cell
+    parser.add_argument('--grid', choices=['dense', 'bitmasked', 'pointer'], default=grid_layout)
+    parser.add_argument('--precision', choices=['f32', 'f16'], default=trajectory_precision) ##Storage of v, C and F in the trajectory
+    parser.add_argument('--sort', choices=['none', 'morton', 'rows'], default=particle_order) ##Order of each robot's particles by grid cell
+    parser.add_argument('--resort', type=int, default=resort_every) ##Iterations between re-sorts by the latest positions, 0 = only when loaded
+    parser.add_argument('--fused', action="store_true") ##Fuse G2P and the next P2G into one particle loop
+    parser.add_argument('--grid-report', action="store_true") ##Print active grid cells per step to stderr after every batch
+    parser.add_argument('--cold', action="store_true") ##Start mutants from fresh random weights instead of their parent's
+    parser.add_argument('--halving', type=halving_rate, default=halving) ##Keep the best 1/n robots after every rung of successive halving, 0 = off
+    parser.add_argument('--profile', nargs='?', const='profile.jsonl', default=None) ##Time every phase and kernel, the breakdown of each generation is appended to this file
+    parser.add_argument('--promote', type=int, default=0) ##Optimize every robot at the coarse fidelity and only this many at full fidelity, 0 = off
+    parser.add_argument('--coarse', default='{n_grid},{particle_density},{steps}'.format(**coarse_fidelity)) ##n_grid,particle density,steps of the coarse fidelity
+    parser.add_argument('--screen', type=int, default=0) ##Candidates screened by a forward pass per generation, the best are optimized
+    parser.add_argument('--metrics', action="store_true") ##Stream the per step metrics of every robot and archive them
+    parser.add_argument('--metric-weights', type=metric_weight_list, default={}) ##name=weight,... of metrics added to the loss
+    parser.add_argument('--snapshot', default='evolution.snapshot') ##File the evolution state is saved to while a run goes, '' disables it
+    parser.add_argument('--snapshot-iters', type=int, default=0) ##Optimization iterations between saves of a batch, 0 = save after every batch
+    parser.add_argument('--resume', action="store_true") ##Continue the run saved in --snapshot, with its optimizer settings
+    parser.add_argument('--queue', default='') ##Directory or host:port of the job queue robots are sent to for -worker processes, '' = evaluate here
+    parser.add_argument('--queue-key', default='diffmpm') ##Key host:port workers authenticate with
+    parser.add_argument('--queue-timeout', type=float, default=120) ##Seconds without a heartbeat before a worker counts as lost
+    parser.add_argument('--retries', type=int, default=job_retries) ##Times a failed or lost job is sent again
+
+def apply_options(options):
+    ##Sets the module settings from parsed options and returns the fitness cache, None if disabled
+    global report_memory, render_mode, report_grid, fused_steps, halving, trajectory_precision, particle_order, resort_every
+    global run_archive, warm_start, report_metrics, metric_weights, snapshot, job_queue, job_retries
+    if options.profile is not None:
+        set_profiling(options.profile)
+    set_n_robots(options.batch)
+    set_grid(options.n_grid, options.grid)
+    set_checkpointing(options.checkpoint)
+    set_config({'optimizer': options.optimizer, 'learning_rate': options.lr, 'lr_schedule': options.lr_schedule,
+                'grad_clip': options.clip, 'patience': options.patience, 'tolerance': options.tol})
+    report_memory = options.memory_report
+    render_mode = options.render
+    report_grid = options.grid_report
+    fused_steps = options.fused
+    trajectory_precision = options.precision
+    particle_order = options.sort
+    coarse_fidelity.update(zip(['n_grid', 'particle_density', 'steps'], [int(v) for v in options.coarse.split(',')]))
+    resort_every = options.resort
+    run_archive = RunArchive(options.archive) if options.archive else None
+    halving = options.halving
+    warm_start = not options.cold
+    report_metrics = options.metrics
+    metric_weights = options.metric_weights
+    snapshot = Snapshot(options.snapshot, options.snapshot_iters, get_config()) if options.snapshot else None
+    job_retries = options.retries
+    job_queue = open_queue(options.queue, options.queue_timeout, options.queue_key, True, queue_poll) if options.queue else None
+    if snapshot and options.resume and snapshot.load():
+        set_config(snapshot.config) ##Last, the saved settings replace the ones just set
+    return FitnessCache(options.cache, options.cache_size) if options.cache else None
+
+def save_cache(cache):
+    cache.save()
+    ##stderr, stdout only holds the best robot and its loss
+    print('Fitness cache: {} hits, {} misses ({:.0%}), {} morphologies stored'.format(
+        cache.hits, cache.misses, cache.hit_rate(), len(cache.entries)), file=sys.stderr)
+
+
+def load_robot(path='robotstorage.json'):
+    ##Graph and optimized (weights, bias) of the stored robot. Files written before the controller was
+    ##stored only hold the graph, their controller is None
+    with open(path, 'r') as f:
+        stored = json.load(f)
+    if isinstance(stored, list):
+        return stored, None
+    return stored['robot'], (stored['weights'], stored['bias'])
+
+def store_robot(result, path='robotstorage.json'):
+    ##Stores a generation_result(), the next mutation generation starts from it
+    with open(path, 'w') as f:
+        json.dump(result, f)
+
+def generation_result(scene, loss, control, iters, render_steps):
+    ##The winner of a generation, drawn first when only winners are rendered
+    if render_mode == 'winner' and iters:
+        replay(scene, *control, render_steps, 'diffmpm/iter{:03d}'.format(iters - 1))
+    return {'loss': loss, 'robot': scene.graph, 'weights': control[0], 'bias': control[1], 'metrics': scene.metrics}
+
+def initial_generation(nodes, population, iters, batch=1, workers=1, cache=None, candidates=0, promoted=0):
+    ##Optimizes population random robots with nodes nodes and returns the best as a dict of
+    ##loss, robot (its graph), weights and bias. With candidates > population, candidates robots are generated
+    ##and only the population best by an untrained forward pass are optimized. With promoted set, those are
+    ##optimized at coarse_fidelity first and only the promoted best are optimized at full fidelity
+    scenes = resumed_scenes('initial', iters)
+    if scenes is None:
+        scenes = [random_scene(nodes) for i in range(max(population, candidates))] #Generate Robots
+        scenes = shortlist(scenes, population)
+        if promoted:
+            scenes = promote(scenes, promoted, iters, batch)
+    if snapshot:
+        snapshot.start_generation('initial', scenes, iters)
+    losses, controllers = evaluate_scenes(scenes, iters, batch, workers, 1532, cache) #Record Losses
+    best = next(i for i in range(len(scenes)) if not scenes[i].dropped)
+    for i in range(len(scenes)): ##Find best loss
+        if losses[i] <= losses[best] and not scenes[i].dropped:
+            best = i
+    if run_archive:
+        run_archive.add_generation('initial', scenes, losses, controllers, iters, best, None, n_grid, steps)
+    result = generation_result(scenes[best], losses[best], controllers[best], iters, 1532)
+    if snapshot:
+        snapshot.end_generation(result)
+    if profiling:
+        write_profile('initial')
+    return result
+
+def mutation_generation(base_robot, mutations, iters, batch=1, workers=1, cache=None, candidates=0, promoted=0,
+                        control=None):
+    ##Rebuilds base_robot mutations times, each with one random extra node, and returns the best mutant
+    ##like initial_generation. control is base_robot's optimized (weights, bias) the mutants start from, if known
+    scenes = resumed_scenes('mutation', iters)
+    if scenes is None:
+        scenes = [mutant_scene(base_robot, control) for i in range(max(mutations, candidates))]
+        scenes = shortlist(scenes, mutations)
+        if promoted:
+            scenes = promote(scenes, promoted, iters, batch)
+    if snapshot:
+        snapshot.start_generation('mutation', scenes, iters)
+    losses, controllers = evaluate_scenes(scenes, iters, batch, workers, 1500, cache)
+    best = next(i for i in range(len(scenes)) if not scenes[i].dropped)
+    for i in range(len(scenes)): ##Find best mutant
+        if losses[i] < losses[best] and not scenes[i].dropped:
+            best = i
+    if run_archive:
+        run_archive.add_generation('mutation', scenes, losses, controllers, iters, best, base_robot, n_grid, steps)
+    result = generation_result(scenes[best], losses[best], controllers[best], iters, 1500)
+    if snapshot:
+        snapshot.end_generation(result)
+    if profiling:
+        write_profile('mutation')
+    return result
+
+class SteadyState:
+    ##Population of a steady-state run: the population best distinct robots seen so far (elites) as
+    ##(loss, scene, (weights, bias)) and counts of the robots started, finished and taken from the fitness cache
+    def __init__(self, nodes, population, tournament=3):
+        self.nodes = nodes
+        self.population = population
+        self.tournament = tournament
+        self.elites = []
+        self.started = self.finished = self.hits = 0
+        self.clock = time.perf_counter()
+
+    def next_scene(self):
+        ##The next robot and the graph of its parent: a random robot until population robots have been
+        ##started, then a mutant of the best of tournament elites drawn at random
+        self.started += 1
+        if self.started <= self.population or not self.elites:
+            return random_scene(self.nodes), None
+        loss, parent, control = min(rand.sample(self.elites, min(self.tournament, len(self.elites))),
+                                    key=lambda elite: elite[0])
+        return mutant_scene(parent.graph, control), parent.graph
+
+    def add(self, scene, parent, loss, control, iters, cached=False):
+        ##Records a finished robot, replacing the worst elite when it is better and not already an elite
+        self.finished += 1
+        self.hits += cached
+        key = morphology_key(scene.graph)[0]
+        kept = all(morphology_key(elite[1].graph)[0] != key for elite in self.elites)
+        if kept and len(self.elites) >= self.population:
+            worst = max(range(len(self.elites)), key=lambda i: self.elites[i][0])
+            kept = loss < self.elites[worst][0]
+            if kept:
+                del self.elites[worst]
+        if kept:
+            self.elites.append((loss, scene, control))
+        if run_archive:
+            run_archive.add_generation('steady', [scene], [loss], [control], iters, 0 if kept else None, parent,
+                                        n_grid, steps)
+        if self.finished % self.population == 0:
+            self.report()
+
+    def best(self):
+        return min(self.elites, key=lambda elite: elite[0])
+
+    def dump(self, pending):
+        ##State for the snapshot, with the (scene, parent) of every robot still being optimized
+        return {'elites': [(loss, scene.graph, control) for loss, scene, control in self.elites],
+                'pending': [(scene.graph, scene.controller, parent) for scene, parent in pending],
+                'counts': (self.started, self.finished, self.hits), 'seconds': time.perf_counter() - self.clock}
+
+    def load(self, saved):
+        ##Restores a dump() and returns its pending robots as (scene, parent)
+        self.elites = [(loss, stored_scene(robot), control) for loss, robot, control in saved['elites']]
+        self.started, self.finished, self.hits = saved['counts']
+        self.clock = time.perf_counter() - saved['seconds']
+        return [(stored_scene(robot, control), parent) for robot, control, parent in saved['pending']]
+
+    def report(self):
+        seconds = time.perf_counter() - self.clock
+        print('Steady state: {} robots in {:.0f}s ({:.0f} per hour), {} from the fitness cache, best loss {:.4f}'.format(
+            self.finished, seconds, 3600 * self.finished / max(seconds, 1e-9), self.hits, self.best()[0]),
+            file=sys.stderr)
+
+def steady_state(nodes, population, evaluations, iters, batch=1, workers=1, cache=None, tournament=3):
+    ##Steady-state evolution without a generation barrier: as soon as any robot is optimized, the next one
+    ##is started. Stops after evaluations robots and returns the best like initial_generation. With job_queue, a
+    ##new robot is queued whenever no job is waiting for a worker, keeping at least workers robots queued. Else with
+    ##workers == 1 robots are optimized here in batches of batch, otherwise every worker process optimizes one at a time
+    state = SteadyState(nodes, population, tournament)
+    pending = []
+    if snapshot and 'steady' in snapshot.state:
+        pending = state.load(snapshot.state['steady']) ##Robots the interrupted run was optimizing go first
+    elif run_archive:
+        run_archive.start_run()
+    if job_queue:
+        queued = QueueJobs(job_queue, job_retries)
+        changed = True ##Only save the snapshot when robots were queued or finished
+        while state.finished < evaluations or pending:
+            while (pending or state.started < evaluations) and (len(queued.jobs) < workers or not job_queue.waiting()):
+                changed = True
+                scene, parent = pending.pop(0) if pending else state.next_scene() ##Keep every worker busy
+                hit = cache.lookup(scene.graph, iters, cache_setup(scene.controller)) if cache else None
+                if hit is None:
+                    queued.submit((scene, parent), (scene.graph, iters, get_config(), scene.controller))
+                else:
+                    state.add(scene, parent, hit[0], hit[1:], iters, True)
+            if snapshot and changed:
+                snapshot.state['steady'] = state.dump(queued.keys() + pending)
+                snapshot.save()
+            finished = queued.finished()
+            changed = bool(finished)
+            for (scene, parent), result in finished:
+                l, robot, w, b, scene.curve, scene.seconds, scene.metrics = result
+                if cache:
+                    cache.store(scene.graph, iters, cache_setup(scene.controller), l, w, b)
+                state.add(scene, parent, l, (w, b), iters)
+            if not finished:
+                time.sleep(queue_poll)
+    elif workers == 1:
+        while state.started < evaluations or pending:
+            jobs = pending or [state.next_scene() for i in range(min(batch, evaluations - state.started))]
+            pending = []
+            scenes = [scene for scene, parent in jobs]
+            if snapshot:
+                snapshot.state['steady'] = state.dump(jobs)
+                snapshot.start_generation('steady', scenes, iters)
+            losses, controllers = evaluate_scenes(scenes, iters, batch, 1, 0, cache)
+            for (scene, parent), l, control in zip(jobs, losses, controllers):
+                state.add(scene, parent, l, control, iters, not scene.curve)
+            if snapshot:
+                snapshot.state['steady'] = state.dump([])
+                snapshot.save()
+    else:
+        workers, threads = pool_size(evaluations, workers)
+        with worker_threads(threads), concurrent.futures.ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            running = {}
+            while state.finished < evaluations or pending:
+                while len(running) < workers and (pending or state.started < evaluations): ##Keep every worker busy
+                    scene, parent = pending.pop(0) if pending else state.next_scene()
+                    hit = cache.lookup(scene.graph, iters, cache_setup(scene.controller)) if cache else None
+                    if hit is None:
+                        job = pool.submit(evaluate_morphology, scene.graph, iters, get_config(), scene.controller)
+                        running[job] = (scene, parent)
+                    else:
+                        state.add(scene, parent, hit[0], hit[1:], iters, True)
+                if snapshot:
+                    snapshot.state['steady'] = state.dump(list(running.values()) + pending)
+                    snapshot.save()
+                done, waiting = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for job in done:
+                    scene, parent = running.pop(job)
+                    l, robot, w, b, scene.curve, scene.seconds, scene.metrics = job.result()
+                    if cache:
+                        cache.store(scene.graph, iters, cache_setup(scene.controller), l, w, b)
+                    state.add(scene, parent, l, (w, b), iters)
+    if state.finished % population:
+        state.report()
+
+    loss, scene, control = state.best()
+    result = generation_result(scene, loss, control, iters, 1500)
+    if profiling:
+        write_profile('steady')
+    return result
+
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-mutate', action="store_true")
     parser.add_argument('-view', action="store_true")
-    parser.add_argument('--iters', type=int, default=10)
-    
-    
+    parser.add_argument('--precision-report', action="store_true") ##Compare --precision with f32 on --batch random robots and exit
+    parser.add_argument('--warm-report', action="store_true") ##Compare cold and warm started mutants of the stored robot and exit
+    parser.add_argument('-worker', action="store_true") ##Evaluate the jobs of --queue instead of running a generation
+    parser.add_argument('--worker-idle', type=float, default=0) ##Seconds without jobs before a worker exits, 0 = never
+    add_options(parser)
     options = parser.parse_args()
-    
-    winners = [] ##Throwaway variable for go
+    if options.worker:
+        if not options.queue:
+            parser.error('-worker needs --queue')
+        run_worker(open_queue(options.queue, options.queue_timeout, options.queue_key, False, queue_poll),
+                   evaluate_morphology, options.worker_idle, options.queue_timeout, queue_poll)
+        return
+    cache = apply_options(options)
+
     nodes = 6 ##Nodes for the initial robot is set manually here
+    generations = 10 ##How many robots to generate
+    mutations = 10 ##How many mutants to generate
+    if options.precision_report:
+        precision_report([random_scene(nodes) for i in range(options.batch)])
+        return
+    if options.warm_report:
+        base_robot, control = load_robot()
+        assert control is not None, "robotstorage.json holds no optimized weights, run a generation first"
+        warm_start_report(base_robot, control, mutations, options.iters, options.batch)
+        return
     #options.mutate=True
    ##Base Robot generation
     if (options.mutate is False) and (options.view is False): 
-        generate(nodes, winners, options.iters, allocate=True)
-        generations = 10
-        ##How many robots to generate
-        robots = []
-        initial_pop_losses = []
-        for i in range(generations):
-            robots, l = generate(nodes, robots, options.iters) #Generate Robot
-            initial_pop_losses.append(l) #Record Loss
-        
-        best = 0
-        for i in range(generations): ##Find best loss
-            if initial_pop_losses[i] <= initial_pop_losses[best]:
-                best = i
-        print(initial_pop_losses[best]) #print best loss and best robot for helper.py
-        print(robots[best]) 
+        result = initial_generation(nodes, generations, options.iters, options.batch, options.workers, cache,
+                                    options.screen, options.promote)
+        print(result['loss']) #print best loss and best robot for control.py
+        print(result['robot'])
     ##Mutant generation
     elif options.mutate:
-
-        mutants=[]
-        with open('robotstorage.json', 'r') as f:
-            base_robot = json.load(f) ##Load base_robot
-        nodes = len(base_robot) + 1 #Add node
-        generate(nodes, mutants, options.iters, allocate=True) ## initialization call for allocate_fields
-        mutations = 10 ##How many mutants to generate
-        mutants = []
-        mutated_losses = []
-
-        for i in range(mutations):
-            mutants, l = rebuild_and_mutate(base_robot, options.iters, mutants, nodes) ##Rebuild previous robot and add a node
-            mutated_losses.append(l)
-            if i==0:
-                best_mutation = 0
-            elif l < mutated_losses[best_mutation]:
-                    best_mutation = i
-        ##Find best mutant and print
-        best_mutant = mutants[best_mutation]
-        best_loss = mutated_losses[best_mutation]
-        print(best_loss)
-        print(best_mutant)
+        base_robot, control = load_robot() ##Load base_robot
+        result = mutation_generation(base_robot, mutations, options.iters, options.batch, options.workers, cache,
+                                     options.screen, options.promote, control)
+        print(result['loss'])
+        print(result['robot'])
 
     elif options.view:
-        tmp = []
-        
-        with open('robotstorage.json', 'r') as f:
-            base_robot = json.load(f)
-        nodes = len(base_robot)
-        generate(nodes, tmp, 10, allocate=True)
-        view(base_robot, 50)
+        base_robot, control = load_robot()
+        view(base_robot, 50, control)
+    if cache and not options.view:
+        save_cache(cache)
+    if snapshot and not options.view:
+        snapshot.finish()
          
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,72 @@
+import os
+import json
+import hashlib
+
+##Losses and optimized controllers of evaluated morphologies, kept on disk between runs so a robot that was
+##already optimized under the same settings is not simulated again. Used by diffmpm.evaluate_scenes()
+
+
+def morphology_key(robot):
+    ##Hash of a graph that ignores node order and horizontal position, plus the x of its leftmost node.
+    ##Only x is normalized: the loss is -x of the final centre of mass, so a shift by dx moves it by -dx,
+    ##while a vertical shift changes how the robot lands
+    x0 = min(node['x'] for node in robot)
+    nodes = sorted((round(node['x'] - x0, 6), round(node['y'], 6), round(node['w'], 6), round(node['h'], 6),
+                    node['act'], node['ptype']) for node in robot)
+    return hashlib.sha1(json.dumps(nodes).encode()).hexdigest(), x0
+
+
+class FitnessCache:
+    ##Loss and optimized controller of every evaluated morphology, stored as JSON and
+    ##bounded to max_entries by evicting the least recently used entries on save. Entries are keyed by the
+    ##morphology hash, the iterations and a hash of cache_setup(), so other settings never reuse them
+    def __init__(self, path, max_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = {}
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        if path and os.path.exists(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+            self.clock = max([entry['used'] for entry in self.entries.values()], default=0)
+
+    def key(self, robot, iters, setup):
+        key, x0 = morphology_key(robot)
+        if any(setup['metric_weights'].values()):
+            key += '-{:.6f}'.format(x0) ##The shift correction only holds for the plain -x loss, so match the position
+        setup = hashlib.sha1(json.dumps(setup, sort_keys=True).encode()).hexdigest()
+        return '{}-{}-{}'.format(key, iters, setup), x0
+
+    def lookup(self, robot, iters, setup):
+        ##Loss, weights and bias of an earlier run with the same iteration count and cache_setup(), None on a miss
+        key, x0 = self.key(robot, iters, setup)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.clock += 1
+        entry['used'] = self.clock
+        if any(setup['metric_weights'].values()):
+            return entry['loss'], entry['weights'], entry['bias'] ##Stored for this x0, see key()
+        return entry['loss'] - (x0 - entry['x0']), entry['weights'], entry['bias']
+
+    def store(self, robot, iters, setup, loss, w, b):
+        key, x0 = self.key(robot, iters, setup)
+        self.clock += 1
+        self.entries[key] = {'loss': loss, 'x0': x0, 'iters': iters, 'weights': w, 'bias': b, 'used': self.clock}
+
+    def save(self):
+        if len(self.entries) > self.max_entries:
+            keep = sorted(self.entries, key=lambda key: self.entries[key]['used'])[-self.max_entries:]
+            self.entries = {key: self.entries[key] for key in keep}
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path) ##Never leaves a half written cache behind
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
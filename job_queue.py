@@ -0,0 +1,277 @@
+import os
+import re
+import sys
+import time
+import uuid
+import pickle
+import threading
+import traceback
+import multiprocessing.managers
+
+##Job queue that spreads robot evaluations over worker processes on any host that can reach it. diffmpm.py
+##coordinates through QueueJobs and its workers run run_worker(). A transport is any object with the methods
+##of DirectoryQueue, a directory shared by every host, and MemoryQueue, kept by the coordinator and served to
+##the workers over a socket
+
+poll_seconds = 0.5 ##Seconds between checks of the queue
+
+
+class DirectoryQueue:
+    ##Job queue in a directory every host can reach. Jobs and results are pickled to files that are written
+    ##under a temporary name and renamed, and a worker claims a job by renaming it into claimed/, which only
+    ##one worker can do. Workers touch their claim while they work, claims untouched for timeout seconds are
+    ##from lost workers. The hosts' clocks have to agree to within the timeout
+    def __init__(self, path, timeout=120):
+        self.path = path
+        self.timeout = timeout
+        for folder in ['jobs', 'claimed', 'results']:
+            os.makedirs(os.path.join(path, folder), exist_ok=True)
+
+    def write(self, folder, id, data):
+        path = os.path.join(self.path, folder, id)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+    def names(self, folder):
+        return sorted(name for name in os.listdir(os.path.join(self.path, folder)) if not name.endswith('.tmp'))
+
+    def clear(self):
+        ##Drops the jobs, claims and results a previous coordinator left behind
+        for folder in ['jobs', 'claimed', 'results']:
+            for name in self.names(folder):
+                os.remove(os.path.join(self.path, folder, name))
+
+    def submit(self, id, job):
+        self.write('jobs', id, job)
+
+    def claim(self):
+        ##(id, job) of the oldest waiting job, ids start with their submission time, None if there is none
+        for id in self.names('jobs'):
+            claimed = os.path.join(self.path, 'claimed', id)
+            try:
+                os.rename(os.path.join(self.path, 'jobs', id), claimed)
+            except FileNotFoundError:
+                continue ##Another worker was first
+            os.utime(claimed)
+            with open(claimed, 'rb') as f:
+                return id, pickle.load(f)
+        return None
+
+    def heartbeat(self, id):
+        try:
+            os.utime(os.path.join(self.path, 'claimed', id))
+        except FileNotFoundError:
+            pass ##Requeued, the result still counts if it arrives first
+
+    def done(self, id, result):
+        self.write('results', id, result)
+        self.unclaim(id)
+
+    def unclaim(self, id):
+        try:
+            os.remove(os.path.join(self.path, 'claimed', id))
+        except FileNotFoundError:
+            pass
+
+    def results(self):
+        ##[(id, result)] of the jobs finished since the last call
+        finished = []
+        for id in self.names('results'):
+            path = os.path.join(self.path, 'results', id)
+            with open(path, 'rb') as f:
+                finished.append((id, pickle.load(f)))
+            os.remove(path)
+        return finished
+
+    def lost(self):
+        ##Ids of the claims whose worker stopped touching them
+        now = time.time()
+        lost = []
+        for id in self.names('claimed'):
+            try:
+                if now - os.path.getmtime(os.path.join(self.path, 'claimed', id)) > self.timeout:
+                    lost.append(id)
+            except FileNotFoundError:
+                pass
+        return lost
+
+    def requeue(self, id, job):
+        self.unclaim(id)
+        self.submit(id, job)
+
+    def waiting(self):
+        ##Jobs no worker has claimed yet
+        return len(self.names('jobs'))
+
+class MemoryQueue:
+    ##The same queue in the coordinator's memory, served to the workers over a socket by QueueManager
+    def __init__(self, timeout=120):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.claimed = {} ##id: (job, time of the last heartbeat)
+        self.finished = []
+
+    def clear(self):
+        pass
+
+    def submit(self, id, job):
+        with self.lock:
+            self.jobs[id] = job
+
+    def claim(self):
+        with self.lock:
+            if not self.jobs:
+                return None
+            id = next(iter(self.jobs))
+            job = self.jobs.pop(id)
+            self.claimed[id] = (job, time.time())
+            return id, job
+
+    def heartbeat(self, id):
+        with self.lock:
+            if id in self.claimed:
+                self.claimed[id] = (self.claimed[id][0], time.time())
+
+    def done(self, id, result):
+        with self.lock:
+            self.claimed.pop(id, None)
+            self.finished.append((id, result))
+
+    def results(self):
+        with self.lock:
+            finished, self.finished = self.finished, []
+            return finished
+
+    def lost(self):
+        now = time.time()
+        with self.lock:
+            return [id for id, (job, beat) in self.claimed.items() if now - beat > self.timeout]
+
+    def requeue(self, id, job):
+        with self.lock:
+            self.claimed.pop(id, None)
+            self.jobs[id] = job
+
+    def waiting(self):
+        with self.lock:
+            return len(self.jobs)
+
+served_queue = None ##MemoryQueue this process serves as a coordinator
+
+def get_served_queue():
+    return served_queue
+
+class QueueManager(multiprocessing.managers.BaseManager):
+    pass
+
+QueueManager.register('queue', callable=get_served_queue)
+
+def open_queue(address, timeout=120, key='diffmpm', serve=True, poll=poll_seconds):
+    ##Transport for --queue: a DirectoryQueue for a path, a MemoryQueue for host:port. The coordinator (serve)
+    ##serves its MemoryQueue on the port from a background thread, workers connect to it and wait up to
+    ##timeout seconds for it to start. Jobs are pickles, so only share the queue and key with trusted hosts
+    global served_queue
+    if not re.fullmatch(r'[\w.-]*:\d+', address):
+        transport = DirectoryQueue(address, timeout)
+        if serve:
+            transport.clear()
+        return transport
+    host, port = address.rsplit(':', 1)
+    manager = QueueManager((host or '127.0.0.1', int(port)), key.encode())
+    if serve:
+        served_queue = MemoryQueue(timeout)
+        threading.Thread(target=manager.get_server().serve_forever, daemon=True).start()
+        return served_queue
+    start = time.perf_counter()
+    while True:
+        try:
+            manager.connect()
+            return manager.queue()
+        except ConnectionRefusedError:
+            if time.perf_counter() - start > timeout:
+                raise
+            time.sleep(poll)
+
+class Heartbeat:
+    ##Tells the queue on a background thread that the claimed job is still being worked on
+    def __init__(self, transport, id, interval):
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(transport, id, interval), daemon=True)
+        self.thread.start()
+
+    def run(self, transport, id, interval):
+        while not self.stopped.wait(interval):
+            transport.heartbeat(id)
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+def run_worker(transport, evaluate, idle=0, timeout=120, poll=poll_seconds):
+    ##Worker loop of diffmpm.py -worker: evaluate(*job) of every job of transport until none came for idle
+    ##seconds, 0 = forever, or a served queue goes away. Failed jobs send back their traceback, the
+    ##coordinator decides whether to retry them
+    waiting = time.perf_counter()
+    while not idle or time.perf_counter() - waiting < idle:
+        try:
+            claimed = transport.claim()
+        except (EOFError, ConnectionError):
+            print('The coordinator stopped serving the queue', file=sys.stderr)
+            return
+        if claimed is None:
+            time.sleep(poll)
+            continue
+        id, job = claimed
+        print('Job {}: {} nodes, {} iterations'.format(id, len(job[0]), job[1]), file=sys.stderr)
+        beat = Heartbeat(transport, id, timeout / 4)
+        try:
+            result = evaluate(*job)
+        except Exception:
+            result = traceback.format_exc()
+        finally:
+            beat.stop()
+        transport.done(id, result)
+        waiting = time.perf_counter()
+
+class QueueJobs:
+    ##Jobs this process sent to a transport and has no result of yet, each under a key of the caller. Jobs
+    ##whose worker raised or was lost are sent again up to retries times
+    def __init__(self, transport, retries=2):
+        self.transport = transport
+        self.retries = retries
+        self.jobs = {} ##id: (key, job, attempts)
+
+    def submit(self, key, job):
+        ##job is the (robot, iters, config, control) arguments of diffmpm.evaluate_morphology()
+        id = '{:020d}-{}'.format(time.time_ns(), uuid.uuid4().hex) ##In submission order for DirectoryQueue.claim()
+        self.jobs[id] = (key, job, 0)
+        self.transport.submit(id, job)
+
+    def keys(self):
+        return [key for key, job, attempts in self.jobs.values()]
+
+    def finished(self):
+        ##[(key, evaluate_morphology() result)] of the jobs finished since the last call
+        failed = {id: 'worker lost' for id in self.transport.lost()}
+        finished = []
+        for id, result in self.transport.results():
+            if id not in self.jobs:
+                continue ##A worker taken for lost finished after all
+            if isinstance(result, str):
+                failed[id] = result ##Once per job, with the error rather than the loss of its worker
+            else:
+                finished.append((self.jobs.pop(id)[0], result))
+        for id, error in failed.items():
+            if id not in self.jobs:
+                continue ##Finished in the same poll it was taken for lost, or not a job of this process
+            key, job, attempts = self.jobs[id]
+            if attempts >= self.retries:
+                raise RuntimeError('Job {} ({} nodes) failed {} times, last error:\n{}'.format(
+                    id, len(job[0]), attempts + 1, error))
+            print('Job {} ({} nodes) failed, sending it again: {}'.format(
+                id, len(job[0]), error.strip().split('\n')[-1]), file=sys.stderr)
+            self.jobs[id] = (key, job, attempts + 1)
+            self.transport.requeue(id, job)
+        return finished
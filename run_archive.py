@@ -0,0 +1,84 @@
+import time
+import json
+import sqlite3
+from fitness_cache import morphology_key
+
+##Append-only SQLite archive of every robot diffmpm.py evaluates, replacing the rewritten loss_storage.json.
+##control.py reads its loss history from it
+
+
+class RunArchive:
+    ##Every evaluated robot with its loss curve, controller, parent and timing, appended to an SQLite file.
+    ##Runs start with an initial generation or a steady-state run, mutation generations continue the latest run
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS robots (id INTEGER PRIMARY KEY, run INTEGER, generation INTEGER,
+                           kind TEXT, key TEXT, parent TEXT, nodes INTEGER, loss REAL, winner INTEGER, cached INTEGER,
+                           iters INTEGER, n_grid INTEGER, steps INTEGER, seconds REAL, created REAL, robot TEXT,
+                           curve TEXT, weights TEXT, bias TEXT, metrics TEXT)''')
+        if 'metrics' not in [column[1] for column in self.db.execute('PRAGMA table_info(robots)')]:
+            self.db.execute('ALTER TABLE robots ADD COLUMN metrics TEXT') ##Archives written before metrics were streamed
+        self.db.execute('CREATE INDEX IF NOT EXISTS by_nodes ON robots (nodes, loss)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS by_run ON robots (run, generation)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS by_key ON robots (key)')
+        self.run, self.generation = self.db.execute(
+            'SELECT COALESCE(MAX(run), -1), COALESCE(MAX(generation), -1) FROM robots '
+            'WHERE run = (SELECT MAX(run) FROM robots)').fetchone()
+
+    def start_run(self):
+        self.run, self.generation = self.run + 1, -1
+
+    def add_generation(self, kind, scenes, losses, controllers, iters, best, parent=None, n_grid=None, steps=None):
+        ##Appends one generation, a new run when kind is initial, and returns the ids of its robots.
+        ##best is the index of the winner, None when no robot won. n_grid and steps are the fidelity it ran at
+        if kind == 'initial' or self.run < 0:
+            self.start_run()
+        self.generation += 1
+        parent = morphology_key(parent)[0] if parent else None
+        ids = []
+        for i, scene in enumerate(scenes):
+            ids.append(self.db.execute(
+                'INSERT INTO robots (run, generation, kind, key, parent, nodes, loss, winner, cached, iters, n_grid, '
+                'steps, seconds, created, robot, curve, weights, bias, metrics) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, '
+                '?, ?, ?, ?, ?, ?, ?, ?)',
+                (self.run, self.generation, kind, morphology_key(scene.graph)[0], parent, len(scene.graph), losses[i],
+                 int(i == best), int(not scene.curve), iters, n_grid, steps, scene.seconds, time.time(),
+                 json.dumps(scene.graph), json.dumps(scene.curve), json.dumps(controllers[i][0]),
+                 json.dumps(controllers[i][1]), json.dumps(scene.metrics))).lastrowid)
+        self.db.commit()
+        return ids
+
+    def rows(self, query, args=()):
+        cursor = self.db.execute(query, args)
+        names = [column[0] for column in cursor.description]
+        rows = [dict(zip(names, row)) for row in cursor.fetchall()]
+        for row in rows:
+            for name in ('robot', 'curve', 'weights', 'bias', 'metrics'):
+                if name in row:
+                    row[name] = json.loads(row[name]) if row[name] is not None else {}
+        return rows
+
+    def best(self, n, nodes=None):
+        ##The n robots with the lowest loss, of all node counts or only with nodes nodes
+        if nodes is None:
+            return self.rows('SELECT * FROM robots ORDER BY loss LIMIT ?', (n,))
+        return self.rows('SELECT * FROM robots WHERE nodes = ? ORDER BY loss LIMIT ?', (nodes, n))
+
+    def winners(self, run=None):
+        ##The winner of every generation of a run, the latest run by default
+        return self.rows('SELECT * FROM robots WHERE run = ? AND winner = 1 ORDER BY generation',
+                         (self.run if run is None else run,))
+
+    def get(self, id):
+        rows = self.rows('SELECT * FROM robots WHERE id = ?', (id,))
+        return rows[0] if rows else None
+
+    def lineage(self, id):
+        ##The robot with this id followed by the earliest archived robot of each of its ancestors
+        rows = [self.get(id)]
+        while rows[-1] and rows[-1]['parent']:
+            parent = self.rows('SELECT * FROM robots WHERE key = ? ORDER BY id LIMIT 1', (rows[-1]['parent'],))
+            if not parent or parent[0]['id'] in [row['id'] for row in rows]:
+                break
+            rows.append(parent[0])
+        return rows
@@ -0,0 +1,110 @@
+import os
+import sys
+import pickle
+import random
+import numpy as np
+
+##Checkpoints of a running evolution, written by diffmpm.py as robots and generations finish so that
+##--resume continues a killed run where it stopped
+
+
+class Snapshot:
+    ##Evolution state saved with pickle so a killed run resumes where it stopped: the winners of the finished
+    ##generations, the robots of the generation in progress with the results of every finished one, the batch
+    ##being optimized as of its last saved iteration, steady-state elites, the random states of random and NumPy
+    ##and the settings (config, diffmpm.get_config() of the run). Only graphs and plain lists or arrays are stored,
+    ##scenes are rebuilt from the graphs
+    def __init__(self, path, every=0, config=None):
+        self.path = path
+        self.every = every ##Optimization iterations between saves of a batch, 0 = save after every batch
+        self.config = config
+        self.state = {}
+
+    def load(self):
+        ##Continue from the file if there is one: restores the random states of the last save and returns
+        ##True, the caller applies the restored config
+        if not os.path.exists(self.path):
+            print('No snapshot at {}, starting a new run'.format(self.path), file=sys.stderr)
+            return False
+        with open(self.path, 'rb') as f:
+            self.state = pickle.load(f)
+        self.config = self.state['config']
+        random.setstate(self.state['random'][0])
+        np.random.set_state(self.state['random'][1])
+        generation, batch = self.state.get('generation'), self.state.get('batch')
+        print('Resuming from {}: {} generations finished{}{}'.format(
+            self.path, len(self.generations()), ', {} of {} robots of the current one'.format(
+                len(generation['results']), len(generation['robots'])) if generation else '',
+            ', a batch at iteration {}'.format(batch['first']) if batch else ''), file=sys.stderr)
+        return True
+
+    def save(self):
+        self.state['config'] = self.config
+        self.state['random'] = (random.getstate(), np.random.get_state())
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(self.state, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path) ##A kill while writing leaves the previous snapshot
+
+    def finish(self):
+        ##The run is complete, so there is nothing left to resume
+        self.state = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def generations(self):
+        ##generation_result() of every finished generation of the run
+        return self.state.get('generations', [])
+
+    def start_generation(self, kind, scenes, iters, parents=None):
+        ##Records the robots about to be evaluated. A record of the same robots is kept with its results
+        robots = [scene.graph for scene in scenes]
+        generation = self.state.get('generation')
+        if generation and generation['robots'] == robots and generation['iters'] == iters:
+            return
+        self.state['generation'] = {'kind': kind, 'iters': iters, 'robots': robots,
+                                    'controllers': [scene.controller for scene in scenes],
+                                    'parents': parents or [None] * len(scenes), 'results': {}}
+        self.state.pop('batch', None)
+        self.save()
+
+    def resumed(self, kind, iters):
+        ##(robots, controllers) of an unfinished generation of this kind, None when there is none to resume
+        generation = self.state.get('generation')
+        if not generation or generation['kind'] != kind:
+            return None
+        assert generation['iters'] == iters, "Resume with the --iters of the interrupted run"
+        return generation['robots'], generation['controllers']
+
+    def finished(self, scenes, iters):
+        ##{index: (loss, (weights, bias), curve, seconds, metrics)} of the robots of scenes already evaluated
+        generation = self.state.get('generation')
+        if not generation or generation['robots'] != [scene.graph for scene in scenes] or generation['iters'] != iters:
+            return {}
+        return generation['results']
+
+    def add_result(self, i, scene, loss, control):
+        generation = self.state.get('generation')
+        if generation:
+            generation['results'][i] = (loss, control, scene.curve, scene.seconds, scene.metrics)
+
+    def saved_batch(self, scenes):
+        ##(iterations done, slot_states()) of the batch of these scenes, None if it was not saved
+        batch = self.state.get('batch')
+        if not batch or batch['robots'] != [scene.graph for scene in scenes]:
+            return None
+        for scene, curve, seconds in zip(scenes, batch['curves'], batch['seconds']):
+            scene.curve, scene.seconds = list(curve), seconds
+        return batch['first'], batch['states']
+
+    def save_batch(self, scenes, first, states):
+        self.state['batch'] = {'robots': [scene.graph for scene in scenes], 'first': first, 'states': states,
+                               'curves': [scene.curve for scene in scenes],
+                               'seconds': [scene.seconds for scene in scenes]}
+        self.save()
+
+    def end_generation(self, result):
+        self.state.setdefault('generations', []).append(result)
+        self.state.pop('generation', None)
+        self.state.pop('batch', None)
+        self.save()
@@ -0,0 +1,98 @@
+import os
+import time
+import pytest
+from job_queue import DirectoryQueue, MemoryQueue, QueueJobs
+
+##Retry and lost-worker handling of QueueJobs on both transports, with stub jobs and results instead of robots.
+##A job is (robot, iters, config, control) like for diffmpm.evaluate_morphology(), only len(job[0]) is used
+
+job = ([{'x': 0.1}, {'x': 0.2}], 1, {}, None)
+result = (-0.5, job[0], [[0.0]], [0.0], [-0.5], 0.1, {})
+
+
+@pytest.fixture(params=['directory', 'memory'])
+def transport(request, tmp_path):
+    if request.param == 'directory':
+        return DirectoryQueue(str(tmp_path / 'queue'), timeout=60)
+    return MemoryQueue(timeout=60)
+
+def lose(transport, id):
+    ##Makes the claim of id look like its worker stopped sending heartbeats
+    old = time.time() - 120
+    if isinstance(transport, DirectoryQueue):
+        os.utime(os.path.join(transport.path, 'claimed', id), (old, old))
+    else:
+        transport.claimed[id] = (transport.claimed[id][0], old)
+
+def test_result(transport):
+    queued = QueueJobs(transport)
+    queued.submit('robot', job)
+    id, claimed = transport.claim()
+    assert claimed == job
+    transport.done(id, result)
+    assert queued.finished() == [('robot', result)]
+    assert not queued.jobs and not transport.lost()
+
+def test_failed_job_is_retried(transport):
+    queued = QueueJobs(transport)
+    queued.submit('robot', job)
+    id, claimed = transport.claim()
+    transport.done(id, 'Traceback\nValueError: boom\n')
+    assert queued.finished() == []
+    assert transport.waiting() == 1
+    assert transport.claim()[0] == id
+    transport.done(id, result)
+    assert queued.finished() == [('robot', result)]
+
+def test_lost_claim_is_requeued(transport):
+    queued = QueueJobs(transport)
+    queued.submit('robot', job)
+    id, claimed = transport.claim()
+    lose(transport, id)
+    assert queued.finished() == []
+    assert not transport.lost()
+    assert transport.claim() == (id, job)
+
+def test_result_in_the_poll_it_is_lost(transport):
+    ##The worker finishes between the lost() and results() calls of one poll: its result counts and the job
+    ##is not sent again
+    queued = QueueJobs(transport)
+    queued.submit('robot', job)
+    id, claimed = transport.claim()
+    lose(transport, id)
+    results = transport.results
+    def finish():
+        transport.done(id, result)
+        return results()
+    transport.results = finish
+    assert queued.finished() == [('robot', result)]
+    assert transport.waiting() == 0 and not queued.jobs
+
+def test_retry_limit_raises(transport):
+    queued = QueueJobs(transport, retries=1)
+    queued.submit('robot', job)
+    for attempt in range(2):
+        id, claimed = transport.claim()
+        transport.done(id, 'Traceback\nValueError: boom {}\n'.format(attempt))
+        if attempt == 0:
+            assert queued.finished() == []
+    with pytest.raises(RuntimeError, match='failed 2 times') as error:
+        queued.finished()
+    assert 'boom 1' in str(error.value)
+
+def test_claims_in_submission_order(transport):
+    queued = QueueJobs(transport)
+    for i in range(5):
+        queued.submit(i, job)
+    ids = list(queued.jobs)
+    assert [transport.claim()[0] for i in range(5)] == ids
+    assert transport.claim() is None
+
+def test_clear_drops_claims(tmp_path):
+    path = str(tmp_path / 'queue')
+    QueueJobs(DirectoryQueue(path)).submit('robot', job)
+    id, claimed = DirectoryQueue(path).claim()
+    lose(DirectoryQueue(path), id)
+    transport = DirectoryQueue(path)
+    transport.clear()
+    assert not transport.lost() and transport.waiting() == 0